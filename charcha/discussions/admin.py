@@ -3,7 +3,7 @@ from django.contrib.contenttypes.admin import GenericTabularInline
 
 from .models import GchatSpace
 from .models import Group, Role, Permission, GroupMember
-from .models import Post, Comment, Reaction, LastSeenOnPost
+from .models import Post, Comment, Reaction, ThreadCursor
 from .models import Favourite, PostSubscribtion
 from .models import User, Tag
 
@@ -15,7 +15,7 @@ class TagAdmin(admin.ModelAdmin):
     fields = ('name', 'parent', 'ext_id', 'attributes', 'ext_link')
     list_display = ('name', 'parent', 'ext_id', 'is_visible', 'attributes', 'ext_link')
 
-class LastSeenOnPostAdmin(admin.ModelAdmin):
+class ThreadCursorAdmin(admin.ModelAdmin):
     fields = ('post', 'user', 'seen')
     list_display = ('post', 'user', 'seen')
     readonly_fields = ('seen', )
@@ -65,7 +65,7 @@ class FavouriteAdmin(admin.ModelAdmin):
 
 admin.site.register(PostSubscribtion, PostSubscribtionAdmin)
 admin.site.register(Tag, TagAdmin)
-admin.site.register(LastSeenOnPost, LastSeenOnPostAdmin)
+admin.site.register(ThreadCursor, ThreadCursorAdmin)
 admin.site.register(GchatSpace, GchatSpaceAdmin)
 admin.site.register(Permission, PermissionAdmin)
 admin.site.register(Role, RoleAdmin)
@@ -1,10 +1,14 @@
 from django.conf import settings
 import json
 import os
+import hashlib
 import logging
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from httplib2 import Http
-from oauth2client.service_account import ServiceAccountCredentials
-from apiclient.discovery import build
 from bleach.sanitizer import Cleaner
 
 logger = logging.getLogger(__name__)
@@ -19,22 +23,84 @@ cleaner = Cleaner(
     strip=True
 )
 
-def _load_chat_client():
+# Discovery documents rarely change, so processes share a copy on disk for this many seconds
+DISCOVERY_CACHE_MAX_AGE = 24 * 60 * 60
+
+class DiscoveryCache:
+    '''Keeps discovery documents in files, so that every process doesn't fetch them from google
+
+    Implements googleapiclient.discovery_cache.base.Cache. The cache that ships with
+    googleapiclient doesn't work with oauth2client 4.x, so without this, 
+    every worker and every management command downloads the document.
+    '''
+    def __init__(self, directory, max_age=DISCOVERY_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.md5(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        # Write to a temporary file and rename it, so that other processes never read a partial document
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_path, self._path(url))
+        except OSError:
+            logger.warning("Cannot cache discovery document in " + self.directory, exc_info=True)
+
+def _load_credentials():
     keyfile_str = os.environ.get('GOOGLE_SERVICE_ACCOUNT_JSON', None)
     if not keyfile_str:
         logger.warn("Environment variable GOOGLE_SERVICE_ACCOUNT_JSON not found. \
             Disabling notifications via google chatbot")
         return None
     
+    from oauth2client.service_account import ServiceAccountCredentials
     keyfile_dict = json.loads(keyfile_str)
     scopes = 'https://www.googleapis.com/auth/chat.bot'
-    credentials = ServiceAccountCredentials.from_json_keyfile_dict(
+    return ServiceAccountCredentials.from_json_keyfile_dict(
         keyfile_dict, scopes)
-    chat_client = build('chat', 'v1', http=credentials.authorize(Http()))
+
+def _load_chat_client(credentials):
+    if not credentials:
+        return None
+    from apiclient.discovery import build
+    chat_client = build('chat', 'v1', http=credentials.authorize(Http()), 
+        cache=DiscoveryCache(settings.GOOGLE_DISCOVERY_CACHE_DIR))
     return chat_client
 
-# chat_client can be None, in which case we will not send any notifications via chat
-_chat_client = _load_chat_client()
+# Loaded on first use, so that importing this module doesn't parse credentials or go to the network
+_credentials = None
+_chat_client = None
+_loaded = False
+_load_lock = threading.Lock()
+
+def _get_chat_client():
+    '''Returns the chat client, or None if notifications via chat are disabled'''
+    global _credentials, _chat_client, _loaded
+    if not _loaded:
+        with _load_lock:
+            if not _loaded:
+                _credentials = _load_credentials()
+                _chat_client = _load_chat_client(_credentials)
+                _loaded = True
+    return _chat_client
+
+def _new_http():
+    return _credentials.authorize(Http())
 
 def members(spaceid):
     members = []
@@ -42,21 +108,72 @@ def members(spaceid):
     is_first_call = True
     while is_first_call or page_token:
         is_first_call = False
-        response = _chat_client.spaces().members().list(parent=spaceid, pageSize=1000, pageToken=page_token).execute()
+        response = _get_chat_client().spaces().members().list(parent=spaceid, pageSize=1000, pageToken=page_token).execute()
         page_token = response['nextPageToken']
         members.extend(response['memberships'])
     return members
 
-def notify_space(spaceid, event):
-    if not _chat_client:
-      return
-    message = _create_message(event)
-    try:
-      _chat_client.spaces().messages() \
-          .create(parent=spaceid, body=message) \
-          .execute()
-    except Exception:
-      logger.exception("Cannot send message to space " + spaceid)
+# Result of Dispatcher.send
+# failures maps the index of every message that could not be sent to the exception
+BatchResult = namedtuple('BatchResult', ['sent', 'failures', 'elapsed'])
+
+class Dispatcher:
+    '''Sends batches of messages to google chat in parallel, over a pool of persistent connections
+
+    Every worker thread keeps its own httplib2.Http, which is not thread safe, 
+    and reuses its connection to google across messages and batches.
+    So a batch of N messages costs N / concurrency round trips, instead of N connection setups.
+    
+    :param chat_client: the discovery client, or None if notifications via chat are disabled. 
+        Every message then fails, see enabled
+    :param new_http: returns a new, authorized httplib2.Http. Called once per worker thread
+    :param concurrency: the number of messages in flight at a time
+    '''
+    def __init__(self, chat_client, new_http, concurrency=8):
+        self.chat_client = chat_client
+        self.new_http = new_http
+        self.concurrency = concurrency
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="chat-dispatcher")
+
+    @property
+    def enabled(self):
+        'False if there is no chat client, because GOOGLE_SERVICE_ACCOUNT_JSON is not set'
+        return self.chat_client is not None
+
+    def send(self, messages):
+        '''Sends a list of (spaceid, event) tuples, and waits until all of them are sent or have failed'''
+        if not self.enabled:
+            e = RuntimeError("Notifications via google chat are disabled")
+            return BatchResult(0, {i: e for i in range(len(messages))}, 0.0)
+        start = time.monotonic()
+        futures = [self._executor.submit(self._send, spaceid, event) for spaceid, event in messages]
+        failures = {}
+        for i, future in enumerate(futures):
+            e = future.exception()
+            if e:
+                logger.warning("Cannot send message to space %s: %s", messages[i][0], e)
+                failures[i] = e
+        elapsed = time.monotonic() - start
+        logger.info("Sent %d messages in %.3fs, %d failed", len(messages) - len(failures), elapsed, len(failures))
+        return BatchResult(len(messages) - len(failures), failures, elapsed)
+
+    def _send(self, spaceid, event):
+        http = getattr(self._local, 'http', None)
+        if not http:
+            http = self._local.http = self.new_http()
+        self.chat_client.spaces().messages() \
+            .create(parent=spaceid, body=_create_message(event)) \
+            .execute(http=http)
+
+_dispatcher = None
+
+def get_dispatcher():
+    '''Returns the dispatcher shared by this process, see settings.GOOGLE_CHAT_CONCURRENCY'''
+    global _dispatcher
+    if not _dispatcher:
+        _dispatcher = Dispatcher(_get_chat_client(), _new_http, settings.GOOGLE_CHAT_CONCURRENCY)
+    return _dispatcher
 
 def _create_message(event):
     # Strip html tags that google chat does not render
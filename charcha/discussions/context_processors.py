@@ -0,0 +1,7 @@
+from .models import ScoreChange
+
+def user_score(request):
+    'Score of the logged in user, including changes that have not been rolled up yet'
+    if not request.user.is_authenticated:
+        return {}
+    return {"user_score": ScoreChange.objects.current_score(request.user)}
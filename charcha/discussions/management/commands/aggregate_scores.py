@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from charcha.discussions.models import ScoreChange
+
+class Command(BaseCommand):
+    help = 'Rolls new entries in the score ledger into users.score'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, 
+            help="Keep running, and roll up every INTERVAL seconds. By default, rolls up once and exits")
+
+    def handle(self, *args, **options):
+        while True:
+            entries, users = ScoreChange.objects.roll_up()
+            if entries:
+                self.stdout.write("Rolled up %d score changes into %d users" % (entries, users))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from charcha.discussions.models import Group, InboxEntry
+
+class Command(BaseCommand):
+    help = 'Rebuilds the inbox that backs the home page. Without arguments, rebuilds the inbox of every user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help="Only rebuild the inbox of this user id")
+        parser.add_argument('--group', type=int, help="Only rebuild entries for posts in this group id")
+
+    def handle(self, *args, **options):
+        if options['group']:
+            group_ids = [options['group']]
+        else:
+            group_ids = list(Group.objects.order_by('id').values_list('id', flat=True))
+
+        # One transaction per group, so that we don't hold locks on the entire inbox table
+        for group_id in group_ids:
+            with transaction.atomic():
+                InboxEntry.objects.rebuild(user_id=options['user'], group_id=group_id)
+            self.stdout.write("Rebuilt inbox entries for group " + str(group_id))
@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from charcha.discussions.models import ThreadCursor
+
+class Command(BaseCommand):
+    help = 'Writes last seen timestamps buffered in the cache to thread_cursors. Only needed when LAST_SEEN_WRITE_BEHIND is on'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, 
+            help="Keep running, and flush every INTERVAL seconds. Use at most LAST_SEEN_FLUSH_INTERVAL. By default, flushes once and exits")
+
+    def handle(self, *args, **options):
+        while True:
+            flushed, updated = ThreadCursor.objects.flush()
+            if flushed:
+                self.stdout.write("Flushed %d last seen timestamps, %d were newer" % (flushed, updated))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
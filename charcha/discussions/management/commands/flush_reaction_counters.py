@@ -0,0 +1,19 @@
+import time
+from django.core.management.base import BaseCommand
+from charcha.discussions.models import PendingReactionDelta
+
+class Command(BaseCommand):
+    help = 'Applies buffered reaction counts. Only needed when REACTION_COUNTERS_WRITE_BEHIND is on'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, 
+            help="Keep running, and flush every INTERVAL seconds. By default, flushes once and exits")
+
+    def handle(self, *args, **options):
+        while True:
+            deltas, posts = PendingReactionDelta.objects.flush()
+            if deltas:
+                self.stdout.write("Flushed %d reaction deltas into %d posts" % (deltas, posts))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
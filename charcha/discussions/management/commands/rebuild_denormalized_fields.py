@@ -0,0 +1,209 @@
+import json
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from charcha.discussions.models import SCORE_FOR_REACTION
+
+# Timestamps are set by separate calls to timezone.now(), so derived timestamps
+# can legitimately differ by a few milliseconds from what they are derived from
+TIMESTAMP_TOLERANCE = "1 second"
+
+# Computes the expected values of the denormalized fields for posts with ids in [lo, hi)
+# Returns one row per post that has drifted, with the current and the repaired value of every field.
+# reaction_summary excludes deltas still pending in pending_reaction_deltas, because readers add them
+# Zero counts in reaction_summary are ignored when comparing
+POSTS_DRIFT = """
+    WITH chunk AS (
+        SELECT id FROM posts WHERE id >= %(lo)s AND id < %(hi)s
+    ), comment_counts AS (
+        SELECT cm.post_id, count(*) as num_comments
+        FROM comments cm JOIN chunk ON cm.post_id = chunk.id
+        WHERE NOT cm.is_deleted
+        GROUP BY cm.post_id
+    ), reaction_counts AS (
+        SELECT post_id, jsonb_object_agg(reaction, n) as reaction_summary
+        FROM (
+            SELECT post_id, reaction, sum(n) as n FROM (
+                SELECT r.post_id, r.reaction, count(*) as n
+                FROM reactions r JOIN chunk ON r.post_id = chunk.id
+                GROUP BY r.post_id, r.reaction
+                UNION ALL
+                SELECT d.post_id, d.reaction, -sum(d.delta)
+                FROM pending_reaction_deltas d JOIN chunk ON d.post_id = chunk.id
+                GROUP BY d.post_id, d.reaction
+            ) counts
+            GROUP BY post_id, reaction
+            HAVING sum(n) <> 0
+        ) per_reaction
+        GROUP BY post_id
+    ), activity AS (
+        SELECT id, max(at) as last_activity FROM (
+            SELECT p.id, p.submission_time as at
+            FROM posts p JOIN chunk ON p.id = chunk.id
+            UNION ALL
+            SELECT cm.post_id, GREATEST(cm.submission_time, cm.last_modified)
+            FROM comments cm JOIN chunk ON cm.post_id = chunk.id
+            UNION ALL
+            SELECT child.parent_post_id, GREATEST(child.submission_time, child.last_modified)
+            FROM posts child JOIN chunk ON child.parent_post_id = chunk.id
+            UNION ALL
+            SELECT child.parent_post_id, GREATEST(cm.submission_time, cm.last_modified)
+            FROM comments cm JOIN posts child ON cm.post_id = child.id
+                JOIN chunk ON child.parent_post_id = chunk.id
+        ) events
+        GROUP BY id
+    ), expected AS (
+        SELECT p.id, p.parent_post_id,
+            p.num_comments, COALESCE(cc.num_comments, 0) as new_num_comments,
+            p.reaction_summary, COALESCE(rc.reaction_summary, '{}'::jsonb) as new_reaction_summary,
+            (SELECT COALESCE(jsonb_object_agg(key, value), '{}'::jsonb)
+                FROM jsonb_each(p.reaction_summary) WHERE value <> '0'::jsonb) as nonzero_reaction_summary,
+            p.last_activity, CASE
+                WHEN abs(extract(epoch FROM p.last_activity - a.last_activity)) > extract(epoch FROM interval %(tolerance)s)
+                THEN a.last_activity ELSE p.last_activity END as new_last_activity,
+            p.last_modified, CASE
+                WHEN p.last_modified < p.submission_time - interval %(tolerance)s
+                THEN p.submission_time ELSE p.last_modified END as new_last_modified
+        FROM posts p JOIN chunk ON p.id = chunk.id
+            JOIN activity a ON a.id = p.id
+            LEFT JOIN comment_counts cc ON cc.post_id = p.id
+            LEFT JOIN reaction_counts rc ON rc.post_id = p.id
+    )
+    SELECT id, parent_post_id, num_comments, new_num_comments, reaction_summary, new_reaction_summary,
+        last_activity, new_last_activity, last_modified, new_last_modified
+    FROM expected
+    WHERE num_comments <> new_num_comments
+        OR nonzero_reaction_summary <> new_reaction_summary
+        OR last_activity <> new_last_activity
+        OR last_modified <> new_last_modified
+"""
+
+# Repairs the drifted posts in the chunk in one statement, and returns them
+# The inbox copies last_activity of top level posts, see InboxEntry
+REPAIR_POSTS = """
+    WITH drift AS (""" + POSTS_DRIFT + """
+    ), repaired AS (
+        UPDATE posts p SET num_comments = d.new_num_comments, reaction_summary = d.new_reaction_summary,
+            last_activity = d.new_last_activity, last_modified = d.new_last_modified
+        FROM drift d
+        WHERE p.id = d.id
+    ), inbox AS (
+        UPDATE inbox i SET last_activity = d.new_last_activity
+        FROM drift d
+        WHERE i.post_id = d.id AND d.parent_post_id IS NULL AND i.last_activity <> d.new_last_activity
+    )
+    SELECT * FROM drift
+"""
+
+# posts.score is not covered - nothing maintains it, so it would show up as drift on every post with reactions
+POST_FIELDS = ('num_comments', 'reaction_summary', 'last_activity', 'last_modified')
+
+# users.score is what reactions on the user's posts add up to, minus changes
+# in the score ledger that haven't been rolled up yet - see ScoreChange.objects.current_score
+# Scores adjusted by hand in the admin also show up as drift, so this only runs with --users
+USERS_DRIFT = """
+    WITH chunk AS (
+        SELECT id FROM users WHERE id >= %(lo)s AND id < %(hi)s
+    ), earned AS (
+        SELECT p.author_id as user_id, sum(s.value::int) as score
+        FROM reactions r JOIN posts p ON r.post_id = p.id
+            JOIN chunk ON p.author_id = chunk.id
+            JOIN jsonb_each_text(%(scores)s::jsonb) s ON s.key = r.reaction
+        GROUP BY p.author_id
+    ), pending AS (
+        SELECT sl.user_id, sum(sl.delta) as score
+        FROM score_ledger sl JOIN chunk ON sl.user_id = chunk.id
+        WHERE NOT sl.rolled_up
+        GROUP BY sl.user_id
+    )
+    SELECT u.id, u.score, (COALESCE(e.score, 0) - COALESCE(pd.score, 0))::int as new_score
+    FROM users u JOIN chunk ON u.id = chunk.id
+        LEFT JOIN earned e ON e.user_id = u.id
+        LEFT JOIN pending pd ON pd.user_id = u.id
+    WHERE u.score <> COALESCE(e.score, 0) - COALESCE(pd.score, 0)
+"""
+
+REPAIR_USERS = """
+    WITH drift AS (""" + USERS_DRIFT + """
+    ), repaired AS (
+        UPDATE users u SET score = d.new_score
+        FROM drift d
+        WHERE u.id = d.id
+    )
+    SELECT * FROM drift
+"""
+
+class Command(BaseCommand):
+    '''Covers num_comments, reaction_summary, last_activity and last_modified on posts, and optionally score on users.
+
+    Works through ids in chunks, with one short transaction per chunk, so it is safe to run nightly on a live database.
+    last_modified cannot be derived from anything, so it is only repaired when it is before submission_time.
+    users.score is recomputed from reactions, which overwrites adjustments made by hand in the admin.
+    So it is only covered with --users, and is best run with --dry-run first to review the differences.
+    '''
+    help = 'Recomputes the denormalized fields on posts and users from the underlying tables, and repairs any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+            help="Only report the differences, don't repair them")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help="Number of ids to process in one transaction")
+        parser.add_argument('--users', action='store_true',
+            help="Also recompute users.score from reactions. Overwrites scores adjusted by hand in the admin")
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.verbose = self.dry_run or options['verbosity'] > 1
+        chunk_size = options['chunk_size']
+        params = {"scores": json.dumps(SCORE_FOR_REACTION), "tolerance": TIMESTAMP_TOLERANCE}
+
+        self.rebuild("posts", POSTS_DRIFT, REPAIR_POSTS, POST_FIELDS, params, chunk_size)
+        if options['users']:
+            self.rebuild("users", USERS_DRIFT, REPAIR_USERS, ('score',), params, chunk_size)
+
+    def rebuild(self, table, drift_query, repair_query, fields, params, chunk_size):
+        drift = {field: 0 for field in fields}
+        for lo, hi in self.chunks(table, chunk_size):
+            with transaction.atomic():
+                rows = self.fetch(table, drift_query, repair_query, dict(params, lo=lo, hi=hi))
+            for row in sorted(rows, key=lambda row: row['id']):
+                for field in fields:
+                    current = row[field]
+                    if field == 'reaction_summary':
+                        current = {k: v for k, v in current.items() if v != 0}
+                    if current != row['new_' + field]:
+                        drift[field] += 1
+                        self.log(table, row['id'], field, row[field], row['new_' + field])
+        self.report(table, drift)
+
+    def chunks(self, table, chunk_size):
+        with connection.cursor() as c:
+            c.execute("SELECT min(id), max(id) FROM " + table)
+            min_id, max_id = c.fetchone()
+        if min_id is None:
+            return
+        for lo in range(min_id, max_id + 1, chunk_size):
+            yield lo, lo + chunk_size
+
+    def fetch(self, table, drift_query, repair_query, params):
+        '''Returns the drifted rows in the chunk, and repairs them unless this is a dry run
+
+        Before repairing, the rows in the chunk are locked. Concurrent updates to the denormalized 
+        fields wait until the chunk is repaired, instead of being overwritten with stale values.
+        '''
+        with connection.cursor() as c:
+            if self.dry_run:
+                c.execute(drift_query, params)
+            else:
+                c.execute("SELECT id FROM " + table + " WHERE id >= %(lo)s AND id < %(hi)s FOR UPDATE", params)
+                c.execute(repair_query, params)
+            columns = [col[0] for col in c.description]
+            return [dict(zip(columns, row)) for row in c.fetchall()]
+
+    def log(self, table, id, field, current, expected):
+        if self.verbose:
+            self.stdout.write("%s %s %s: %s -> %s" % (table, id, field, current, expected))
+
+    def report(self, table, drift):
+        verb = "Would repair" if self.dry_run else "Repaired"
+        for field, count in drift.items():
+            self.stdout.write("%s %s.%s on %d rows" % (verb, table, field, count))
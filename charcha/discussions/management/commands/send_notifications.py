@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from charcha.discussions.models import OutboxMessage
+from charcha.discussions.bot import get_dispatcher
+
+class Command(BaseCommand):
+    help = 'Sends queued google chat notifications from the outbox, retrying failed messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, 
+            help="Keep running, and poll the outbox every INTERVAL seconds. By default, empties the outbox once and exits")
+        parser.add_argument('--batch-size', type=int, default=50,
+            help="Number of messages to lock and send in one transaction")
+
+    def handle(self, *args, **options):
+        if not get_dispatcher().enabled:
+            self.stderr.write("Notifications via google chat are disabled, messages will stay in the outbox")
+        while True:
+            # Keep going while there are full batches, so that a backlog drains without waiting
+            while True:
+                result = OutboxMessage.objects.send_pending(options['batch_size'])
+                failed = len(result.failures)
+                if result.sent or failed:
+                    self.stdout.write("Sent %d notifications in %.2fs, %d failed" % (result.sent, result.elapsed, failed))
+                if result.sent + failed < options['batch_size']:
+                    break
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
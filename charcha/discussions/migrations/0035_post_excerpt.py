@@ -0,0 +1,45 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:12
+
+from django.db import migrations, models
+from django.utils.text import Truncator
+import html as htmllib
+import re
+
+# A copy of make_excerpt in models.py as of this migration, 
+# so that later changes to it don't change what this migration does
+EXCERPT_LENGTH = 200
+tag_regex = re.compile(r"<[^>]*>")
+whitespace_regex = re.compile(r"\s+")
+
+def make_excerpt(html):
+    text = re.sub(tag_regex, " ", html)
+    text = htmllib.unescape(text)
+    text = re.sub(whitespace_regex, " ", text).strip()
+    return Truncator(text).chars(EXCERPT_LENGTH)
+
+def populate_excerpts(apps, schema_editor):
+    Post = apps.get_model("discussions", "Post")
+    batch = []
+    for post in Post.objects.only('id', 'html').order_by('id').iterator(chunk_size=500):
+        post.excerpt = make_excerpt(post.html)
+        batch.append(post)
+        if len(batch) >= 500:
+            Post.objects.bulk_update(batch, ['excerpt'])
+            batch = []
+    if batch:
+        Post.objects.bulk_update(batch, ['excerpt'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0034_auto_20200728_0518'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.RunPython(populate_excerpts, migrations.RunPython.noop),
+    ]
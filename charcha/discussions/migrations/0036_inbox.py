@@ -0,0 +1,64 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Group.OPEN as of this migration
+OPEN_GROUP = 0
+
+# A copy of FILL_INBOX in models.py as of this migration, 
+# so that later changes to it don't change what this migration does
+FILL_INBOX = """
+    INSERT INTO inbox(user_id, post_id, group_id, last_activity, submission_time)
+    SELECT u.id, p.id, p.group_id, p.last_activity, p.submission_time
+    FROM posts p JOIN groups g on p.group_id = g.id
+        JOIN users u on u.is_active = true
+    WHERE p.parent_post_id is null
+    AND (g.group_type = %s OR EXISTS (SELECT 'x'
+        FROM group_members gm WHERE gm.group_id = g.id
+        AND gm.user_id = u.id
+    ))
+    ON CONFLICT (user_id, post_id) DO NOTHING
+"""
+
+def populate_inbox(apps, schema_editor):
+    with schema_editor.connection.cursor() as c:
+        c.execute(FILL_INBOX, [OPEN_GROUP])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0035_post_excerpt'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField()),
+                ('submission_time', models.DateTimeField()),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Group')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Post')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'inbox',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['user', '-last_activity', '-post'], name='inbox_user_last_activity'),
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['user', '-submission_time', '-post'], name='inbox_user_submission_time'),
+        ),
+        migrations.AddConstraint(
+            model_name='inboxentry',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='inbox_unique_user_post'),
+        ),
+        migrations.RunPython(populate_inbox, migrations.RunPython.noop),
+    ]
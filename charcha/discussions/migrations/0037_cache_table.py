@@ -0,0 +1,16 @@
+from django.core.management import call_command
+from django.db import migrations
+
+def create_cache_table(apps, schema_editor):
+    # Groups visible to a user are cached in the database cache, see settings.CACHES
+    call_command('createcachetable', database=schema_editor.connection.alias)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0036_inbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0037_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(parent_post=None), fields=['-last_activity', '-id'], name='posts_feed_last_activity'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(parent_post=None), fields=['-submission_time', '-id'], name='posts_feed_submission_time'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(parent_post=None), fields=['group', '-last_activity', '-id'], name='posts_group_last_activity'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(parent_post=None), fields=['group', '-submission_time', '-id'], name='posts_group_submission_time'),
+        ),
+        migrations.AddIndex(
+            model_name='posttag',
+            index=models.Index(fields=['tag', 'post'], name='post_tags_tag_post'),
+        ),
+    ]
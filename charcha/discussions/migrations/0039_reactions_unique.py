@@ -0,0 +1,30 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0038_feed_indexes'),
+    ]
+
+    operations = [
+        # Concurrent votes could create duplicate reactions, keep the oldest one
+        migrations.RunSQL("""
+            DELETE FROM reactions r
+            USING reactions older
+            WHERE older.post_id = r.post_id 
+            AND older.author_id = r.author_id
+            AND older.reaction = r.reaction
+            AND older.id < r.id
+        """, migrations.RunSQL.noop),
+        migrations.AlterIndexTogether(
+            name='reaction',
+            index_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='reaction',
+            constraint=models.UniqueConstraint(fields=('post', 'author', 'reaction'), name='reactions_unique_post_author_reaction'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0039_reactions_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingReactionDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reaction', models.CharField(max_length=1)),
+                ('delta', models.IntegerField()),
+                ('score_delta', models.IntegerField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Post')),
+                ('post_author', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'pending_reaction_deltas',
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0040_pending_reaction_deltas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoreChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reaction', models.CharField(blank=True, max_length=1)),
+                ('delta', models.IntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('rolled_up', models.BooleanField(default=False)),
+                ('post', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Post')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'score_ledger',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='scorechange',
+            index=models.Index(fields=['user', 'created'], name='score_ledger_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='scorechange',
+            index=models.Index(condition=models.Q(rolled_up=False), fields=['user'], name='score_ledger_pending'),
+        ),
+        # Score changes buffered with the reaction counters now go to the ledger
+        migrations.RunSQL("""
+            INSERT INTO score_ledger(user_id, post_id, reaction, delta, created, rolled_up)
+            SELECT post_author_id, post_id, reaction, score_delta, now(), false
+            FROM pending_reaction_deltas WHERE score_delta <> 0
+        """, migrations.RunSQL.noop),
+        migrations.RemoveField(
+            model_name='pendingreactiondelta',
+            name='post_author',
+        ),
+        migrations.RemoveField(
+            model_name='pendingreactiondelta',
+            name='score_delta',
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0041_score_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingLastSeen',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seen', models.DateTimeField()),
+                ('post', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Post')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'pending_last_seen',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='pendinglastseen',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='pendinglastseen_unique_user_post'),
+        ),
+        # Pending rows are cheap to lose, so skip the write ahead log
+        migrations.RunSQL("ALTER TABLE pending_last_seen SET UNLOGGED", "ALTER TABLE pending_last_seen SET LOGGED"),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Collapses last_seen_on_post - one row per user and post - into one cursor per user and thread.
+# Pending rows are per post as well, so they are merged first. 
+# A cursor can't represent a thread where some posts were seen later than others, so the conversion is lossy.
+# It errs towards unread: the cursor takes the oldest timestamp across the thread's posts the user has rows for, 
+# and stays below the last change of every child post the user never opened, which had no row and was unread.
+# So nothing that was unread becomes read, but posts read after the oldest of them show as unread again.
+COMPACT_LAST_SEEN = """
+    INSERT INTO last_seen_on_post as ls (user_id, post_id, seen)
+    SELECT user_id, post_id, seen FROM pending_last_seen
+    ON CONFLICT (user_id, post_id) DO UPDATE
+    SET seen = GREATEST(ls.seen, EXCLUDED.seen);
+
+    DELETE FROM pending_last_seen;
+
+    INSERT INTO thread_cursors(user_id, post_id, seen)
+    SELECT seen.user_id, seen.thread_id, LEAST(seen.seen, (
+            SELECT min(c.last_modified) - interval '1 microsecond' FROM posts c
+            WHERE c.parent_post_id = seen.thread_id
+            AND NOT EXISTS (SELECT 'x' FROM last_seen_on_post ls 
+                WHERE ls.user_id = seen.user_id AND ls.post_id = c.id)
+        ))
+    FROM (
+        SELECT ls.user_id, COALESCE(p.parent_post_id, p.id) as thread_id, min(ls.seen) as seen
+        FROM last_seen_on_post ls JOIN posts p on ls.post_id = p.id
+        GROUP BY ls.user_id, COALESCE(p.parent_post_id, p.id)
+    ) seen;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0042_pending_last_seen'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seen', models.DateTimeField()),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Group')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'group_watermarks',
+            },
+        ),
+        migrations.CreateModel(
+            name='ThreadCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seen', models.DateTimeField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Post')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'thread_cursors',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='threadcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'post'), name='threadcursors_unique_user_post'),
+        ),
+        migrations.AddConstraint(
+            model_name='groupwatermark',
+            constraint=models.UniqueConstraint(fields=('user', 'group'), name='groupwatermarks_unique_user_group'),
+        ),
+        migrations.RunSQL(COMPACT_LAST_SEEN, migrations.RunSQL.noop),
+        migrations.RemoveField(
+            model_name='post',
+            name='last_seen',
+        ),
+        migrations.DeleteModel(
+            name='LastSeenOnPost',
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:41
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0043_thread_cursors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('space', models.CharField(max_length=100)),
+                ('event', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('available_at', models.DateTimeField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('given_up', models.BooleanField(default=False)),
+            ],
+            options={
+                'db_table': 'notification_outbox',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(given_up=False), fields=['available_at', 'id'], name='outbox_pending'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0044_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='postsubscribtion',
+            index=models.Index(fields=['post', 'notify_on', 'user'], name='post_subscriptions_post_notify'),
+        ),
+        migrations.AlterField(
+            model_name='postsubscribtion',
+            name='post',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, to='discussions.Post'),
+        ),
+    ]
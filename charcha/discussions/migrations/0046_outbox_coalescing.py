@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0045_post_subscriptions_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='thread',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='discussions.Post'),
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(('attempts', 0), ('given_up', False)), fields=['space', 'thread'], name='outbox_held'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.7 on 2026-10-18 04:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0046_outbox_coalescing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AclVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'acl_version',
+            },
+        ),
+        migrations.RunSQL("INSERT INTO acl_version(id, version) VALUES (1, 0)", migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.7 on 2026-10-18 05:10
+
+from django.db import migrations
+
+# Last seen timestamps are now buffered in the cache. Flush whatever is still pending before dropping the table
+FLUSH_PENDING = """
+    INSERT INTO thread_cursors as tc (user_id, post_id, seen)
+    SELECT user_id, post_id, seen FROM pending_last_seen
+    ON CONFLICT (user_id, post_id) DO UPDATE 
+    SET seen = EXCLUDED.seen
+    WHERE tc.seen < EXCLUDED.seen
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0047_acl_version'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FLUSH_PENDING, migrations.RunSQL.noop),
+        migrations.DeleteModel(
+            name='PendingLastSeen',
+        ),
+    ]
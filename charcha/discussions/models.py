@@ -1,5 +1,7 @@
 from collections import defaultdict
 import re
+import datetime
+import html as htmllib
 from itertools import chain
 from django.db import connection
 from django.utils import timezone
@@ -11,12 +13,17 @@ from django.conf import settings
 from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import F, Q, Prefetch, OuterRef, Subquery, Count, Exists
+from django.db.models import F, Q, Prefetch, OuterRef, Subquery, Count, Exists, Case, When, Value
+from django.db.models.functions import Trunc, Greatest
 from django.urls import reverse
-from .bot import notify_space
+from django.utils.text import Truncator
+from .bot import get_dispatcher, BatchResult
 from bleach.sanitizer import Cleaner
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.core.cache import cache
 
 import re
 
@@ -49,6 +56,18 @@ def clean_and_normalize_html(html):
     html = cleaner.clean(html)
     return re.sub(regex, r"<h3>\1</h3>", html)
 
+# Length of the plain text excerpt shown for each post in the feeds
+EXCERPT_LENGTH = 200
+tag_regex = re.compile(r"<[^>]*>")
+whitespace_regex = re.compile(r"\s+")
+
+def make_excerpt(html):
+    'Converts normalized html to a short plain text excerpt'
+    text = re.sub(tag_regex, " ", html)
+    text = htmllib.unescape(text)
+    text = re.sub(whitespace_regex, " ", text).strip()
+    return Truncator(text).chars(EXCERPT_LENGTH)
+
 def extract_mentions(html, exclude=None):
     """
     :param html: normalized html text
@@ -71,8 +90,11 @@ def send_notification_on_mentions(post_or_comment):
     '''Notifies users if they were mentioned in the post or comment. 
     Returns a set of user ids that were notified
     This can be used to prevent duplicate notifications for the same event
+    Users who haven't added the bot in google chat have no space, and are skipped
     '''
-    users = extract_mentions(post_or_comment.html)
+    users = list(extract_mentions(post_or_comment.html)\
+        .exclude(gchat_space__isnull=True)\
+        .exclude(gchat_space=''))
     if not users:
         return {}
     
@@ -110,7 +132,7 @@ def send_notification_on_mentions(post_or_comment):
     
     # actually notify the users
     for user in users:
-        notify_space(user.gchat_space, event)
+        OutboxMessage.objects.enqueue(user.gchat_space, event)
     
     # return the set of users that were notified
     return set([u.id for u in users])
@@ -147,6 +169,14 @@ class User(AbstractUser):
     gchat_space = models.CharField(max_length=50, default=None, blank=True, null=True)
     tzname = models.CharField(max_length=50, default='Asia/Kolkata')
 
+    def save(self, *args, **kwargs):
+        is_create = self._state.adding
+        super().save(*args, **kwargs)
+        # However the user was created - social login, the admin or createsuperuser - 
+        # the home page needs posts in open groups
+        if is_create:
+            InboxEntry.objects.rebuild(user_id=self.id)
+
 class GchatSpace(models.Model):
     class Meta:
         db_table = "gchat_spaces"
@@ -158,13 +188,101 @@ class GchatSpace(models.Model):
     def __str__(self):
         return self.name
 
+# Cached copy of AclVersion, see GroupsManager.visible_group_ids
+ACL_VERSION_KEY = "acl_version"
+
+# Upper bound on how long a stale set of visible groups can survive
+VISIBLE_GROUPS_TIMEOUT = 15 * 60
+
+def _visible_groups_key(user_id):
+    return "visible_groups:%d" % user_id
+
+# Incremented on every invalidate_visible_groups in this process, 
+# so that a request that changes memberships doesn't keep using the list memoized on the user
+_acl_changes_in_process = 0
+
 class GroupsManager(models.Manager):
     def for_user(self, user):
         # Return a queryset that only returns groups the user has access to
         return Group.objects\
-            .filter(Q(Exists(GroupMember.objects.only('id').filter(group=OuterRef('pk'), user=user))) | Q(group_type=Group.OPEN))\
+            .filter(pk__in=self.visible_group_ids(user))\
             .filter(is_deleted=False)
 
+    def visible_group_ids(self, user):
+        '''Returns the ids of groups whose posts the user can see - open groups, and groups the user is a member of
+
+        The list is cached per user, and is invalidated when the user's memberships change
+        or when an open group is created or changes type. See invalidate_visible_groups.
+        It is also memoized on the user object, so a request only goes to the cache once.
+        '''
+        memo = getattr(user, '_visible_group_ids', None)
+        if memo and memo[0] == _acl_changes_in_process:
+            return memo[1]
+        group_ids = self._cached_visible_group_ids(user)
+        user._visible_group_ids = (_acl_changes_in_process, group_ids)
+        return group_ids
+
+    def _cached_visible_group_ids(self, user):
+        key = _visible_groups_key(user.id)
+        cached = cache.get_many([ACL_VERSION_KEY, key])
+        acl_version = cached.get(ACL_VERSION_KEY)
+        if acl_version is None:
+            # The version lives in the database, so losing the cached copy doesn't invalidate every user's entry
+            acl_version = AclVersion.objects.current()
+            cache.set(ACL_VERSION_KEY, acl_version, VISIBLE_GROUPS_TIMEOUT)
+        
+        entry = cached.get(key)
+        if entry and entry[0] == acl_version:
+            return entry[1]
+
+        group_ids = list(Group.objects\
+            .filter(Q(Exists(GroupMember.objects.only('id').filter(group=OuterRef('pk'), user=user))) | Q(group_type=Group.OPEN))\
+            .order_by('id')\
+            .values_list('id', flat=True))
+        cache.set(key, (acl_version, group_ids), VISIBLE_GROUPS_TIMEOUT)
+        return group_ids
+
+    def invalidate_visible_groups(self, user_id=None):
+        '''Discards the cached visible groups of a user, or of all users if user_id is None
+
+        The cache is only cleared once the current transaction commits,
+        otherwise a concurrent request could cache the old memberships again.
+        Lists memoized on user objects in this process are discarded right away.
+        '''
+        global _acl_changes_in_process
+        _acl_changes_in_process += 1
+        if not user_id:
+            AclVersion.objects.bump()
+        def _invalidate():
+            if user_id:
+                cache.delete(_visible_groups_key(user_id))
+            else:
+                cache.delete(ACL_VERSION_KEY)
+        transaction.on_commit(_invalidate)
+
+class AclVersionManager(models.Manager):
+    # The migration creates the row, get_or_create covers databases created without migrations
+    def current(self):
+        return self.get_or_create(id=1)[0].version
+
+    def bump(self):
+        if not self.filter(id=1).update(version=F('version') + 1):
+            self.get_or_create(id=1, defaults={'version': 1})
+
+class AclVersion(models.Model):
+    '''A single row, bumped whenever a change can affect the visible groups of every user,
+    for example when the type of a group changes
+
+    Cached visible groups are only used if they were computed under the current version.
+    A cached copy of the version can be evicted, or go stale for up to VISIBLE_GROUPS_TIMEOUT
+    if a reader races with a bump - the same bound as for the cached groups themselves.
+    '''
+    class Meta:
+        db_table = "acl_version"
+
+    objects = AclVersionManager()
+    version = models.BigIntegerField(default=0)
+
 class Group(models.Model):
     OPEN = 0
     CLOSED = 1
@@ -192,7 +310,7 @@ class Group(models.Model):
     @classmethod
     def get(klass, id, user):
         # Alternative get method to ensure user only sees Posts they have access to
-        return klass.objects.get(Q(Exists(GroupMember.objects.only('id').filter(group=OuterRef('pk'), user=user))) | Q(group_type=Group.OPEN), pk=id)
+        return klass.objects.get(pk__in=klass.objects.visible_group_ids(user), pk=id)
 
     def _slugify(self, title):
         slug = title.lower()
@@ -201,6 +319,7 @@ class Group(models.Model):
         slug = re.sub("\s+", "-", slug)
         return slug
 
+    @transaction.atomic
     def new_post(self, author, post):
         post.author = author
         post.slug = self._slugify(post.title)
@@ -209,6 +328,7 @@ class Group(models.Model):
         now = timezone.now()
         post.last_modified = now
         post.save()
+        InboxEntry.objects.deliver(post)
 
         self._send_new_post_notifications(post)
         PostSubscribtion.objects.subscribe(post, author, PostSubscribtion.NEW_POSTS_AND_REPLIES_ONLY)
@@ -262,6 +382,9 @@ class Group(models.Model):
                 on im.key = u.gchat_primary_key
                 and im.status = 'new'
             """, [self.id, role_member.id])
+
+        InboxEntry.objects.rebuild(group_id=self.id)
+        Group.objects.invalidate_visible_groups()
                 
 
     def _send_new_post_notifications(self, post):
@@ -282,7 +405,7 @@ class Group(models.Model):
     
         if not self.gchat_space.is_deleted:
             space_id = self.gchat_space.space
-            notify_space(space_id, event)
+            OutboxMessage.objects.enqueue(space_id, event)
 
     def get_permissions(self, user):
         permissions = []
@@ -315,6 +438,19 @@ class Group(models.Model):
                 return True
         raise PermissionDenied("User " + str(user) + " does not have permission " + permission + " in group " + str(self))
 
+    def save(self, *args, **kwargs):
+        old_group_type = None
+        if self.pk:
+            old_group_type = Group.objects.filter(pk=self.pk).values_list('group_type', flat=True).first()
+        super().save(*args, **kwargs)
+        
+        # Changing the group type changes who can see the posts in this group
+        if old_group_type is not None and old_group_type != self.group_type:
+            InboxEntry.objects.rebuild(group_id=self.id)
+        # Everyone sees open groups, members see the others - and new members invalidate their own list
+        if self.group_type != old_group_type and Group.OPEN in (self.group_type, old_group_type):
+            Group.objects.invalidate_visible_groups()
+
     def __str__(self):
         return self.name
 
@@ -355,86 +491,396 @@ class GroupMember(models.Model):
     role = models.ForeignKey(Role, on_delete=models.PROTECT)
     added_from_gchat = models.BooleanField()
 
+    def save(self, *args, **kwargs):
+        is_create = self._state.adding
+        super().save(*args, **kwargs)
+        if is_create:
+            InboxEntry.objects.rebuild(user_id=self.user_id, group_id=self.group_id)
+            Group.objects.invalidate_visible_groups(self.user_id)
+
+@receiver(post_delete, sender=GroupMember)
+def _on_group_member_deleted(sender, instance, **kwargs):
+    # A signal instead of GroupMember.delete, so that queryset deletes - like the admin's bulk delete - also run it
+    InboxEntry.objects.rebuild(user_id=instance.user_id, group_id=instance.group_id)
+    Group.objects.invalidate_visible_groups(instance.user_id)
+
+# Number of posts shown on a single page of the home, group and tag feeds
+POSTS_PER_PAGE = 25
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def _encode_cursor(timestamp, post_id):
+    'Encodes the sort key of the last post on a page, so that the next page can start after it'
+    micros = (timestamp - _EPOCH) // datetime.timedelta(microseconds=1)
+    return "%d_%d" % (micros, post_id)
+
+def _decode_cursor(cursor):
+    'Returns a (timestamp, post_id) tuple, or None if the cursor is missing or malformed'
+    if not cursor:
+        return None
+    try:
+        micros, post_id = cursor.split("_")
+        return (_EPOCH + datetime.timedelta(microseconds=int(micros)), int(post_id))
+    except (ValueError, OverflowError):
+        return None
+
+def _keyset_page(queryset, sort_field, id_field, before):
+    '''Returns one page of rows ordered by (sort_field, id_field) descending, and the cursor for the next page'''
+    cursor = _decode_cursor(before)
+    if cursor:
+        timestamp, row_id = cursor
+        # The first filter is redundant, but lets postgres use an index range scan
+        queryset = queryset\
+            .filter(**{sort_field + "__lte": timestamp})\
+            .filter(Q(**{sort_field + "__lt": timestamp}) | Q(**{sort_field: timestamp, id_field + "__lt": row_id}))
+
+    queryset = queryset.order_by("-" + sort_field, "-" + id_field)
+    
+    # Fetch one extra row to find out if there is another page
+    rows = list(queryset[:POSTS_PER_PAGE + 1])
+    next_cursor = None
+    if len(rows) > POSTS_PER_PAGE:
+        rows = rows[:POSTS_PER_PAGE]
+        last_row = rows[-1]
+        next_cursor = _encode_cursor(getattr(last_row, sort_field), getattr(last_row, id_field))
+    return (rows, next_cursor)
+
+# How much a reaction adds to the score of the author of the post
+SCORE_FOR_REACTION = {
+    '👍': 1,
+    '👎': -1,
+    '😀': 1,
+}
+
+# Toggles a reaction and records the author's score change in a single statement, see PostsManager.react
+# Followed by either APPLY_REACTION or BUFFER_REACTION, which use the delta
+TOGGLE_REACTION = """
+    WITH target AS (
+        SELECT p.id, p.author_id FROM posts p JOIN groups g on p.group_id = g.id
+        WHERE p.id = %(post_id)s 
+        AND p.author_id <> %(user_id)s
+        AND (g.group_type = %(open)s OR EXISTS (SELECT 'x'
+            FROM group_members gm WHERE gm.group_id = g.id 
+            AND gm.user_id = %(user_id)s
+        ))
+    ), deleted AS (
+        DELETE FROM reactions r USING target
+        WHERE r.post_id = target.id AND r.author_id = %(user_id)s AND r.reaction = %(reaction)s
+        RETURNING r.id
+    ), inserted AS (
+        INSERT INTO reactions(post_id, author_id, reaction, submission_time)
+        SELECT target.id, %(user_id)s, %(reaction)s, now() FROM target
+        WHERE NOT EXISTS (SELECT 'x' FROM deleted)
+        ON CONFLICT (post_id, author_id, reaction) DO NOTHING
+        RETURNING id
+    ), delta AS (
+        SELECT (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted) as n
+    ), score AS (
+        INSERT INTO score_ledger(user_id, post_id, reaction, delta, created, rolled_up)
+        SELECT target.author_id, target.id, %(reaction)s, delta.n * %(score)s, now(), false
+        FROM target, delta
+        WHERE delta.n <> 0
+    )
+"""
+
+# Updates the counter immediately
+APPLY_REACTION = """
+    UPDATE posts p 
+    SET reaction_summary = jsonb_set(p.reaction_summary, ARRAY[%(reaction)s], 
+        to_jsonb(COALESCE((p.reaction_summary->>%(reaction)s)::int, 0) + delta.n))
+    FROM target, delta
+    WHERE p.id = target.id
+    RETURNING (p.reaction_summary->>%(reaction)s)::int
+"""
+
+# Records the change in pending_reaction_deltas instead, see PendingReactionDelta
+# The new row is not visible to this statement, so the returned count adds delta.n explicitly
+BUFFER_REACTION = """
+    , pending AS (
+        INSERT INTO pending_reaction_deltas(post_id, reaction, delta)
+        SELECT target.id, %(reaction)s, delta.n
+        FROM target, delta
+        WHERE delta.n <> 0
+    )
+    SELECT COALESCE((p.reaction_summary->>%(reaction)s)::int, 0) + delta.n + COALESCE((
+        SELECT sum(d.delta) FROM pending_reaction_deltas d 
+        WHERE d.post_id = p.id AND d.reaction = %(reaction)s), 0)
+    FROM posts p, target, delta
+    WHERE p.id = target.id
+"""
+
 class PostsManager(models.Manager):
     def for_user(self, user):
-        return Post.objects.filter(Q(Exists(GroupMember.objects.only('id').filter(group=OuterRef('group'), user=user))) | Q(group__group_type=Group.OPEN))
+        return Post.objects.filter(group_id__in=Group.objects.visible_group_ids(user))
 
-    def get_post_details(self, post_id, user):
-        parent_post = Post.objects\
-            .select_related("author")\
-            .prefetch_related(Prefetch("comments", queryset=Comment.objects.select_related("author").filter(is_deleted=False).order_by('submission_time')))\
-            .select_related("group")\
-            .prefetch_related("tags")\
-            .annotate(lastseen_timestamp=Subquery(LastSeenOnPost.objects.filter(post=OuterRef('pk'), user=user).only('seen').values('seen')[:1]))\
-            .annotate(my_subscription=Subquery(PostSubscribtion.objects.filter(post=OuterRef('pk'), user=user).only('notify_on').values('notify_on')[:1]))\
-            .get(pk=post_id)
-        
-        child_posts = list(Post.objects\
-            .select_related("author")\
-            .prefetch_related(Prefetch("comments", queryset=Comment.objects.select_related("author").filter(is_deleted=False).order_by('submission_time')))\
-            .annotate(lastseen_timestamp=Subquery(LastSeenOnPost.objects.filter(post=OuterRef('pk'), user=user).only('seen').values('seen')[:1]))\
-            .filter(parent_post__id = post_id)\
-            .order_by("submission_time"))
+    def react(self, post_id, user, reaction_emoji):
+        '''Adds the reaction if the user hasn't reacted this way on the post, otherwise removes it.
         
-        post_and_child_posts = [parent_post]
-        post_and_child_posts.extend(child_posts)
-
-        for post in post_and_child_posts:
+        The reaction, the count in posts.reaction_summary and the change to the author's score
+        are all written in one statement, so concurrent votes cannot lose updates.
+        The score change goes to the ledger, see ScoreChange. With settings.REACTION_COUNTERS_WRITE_BEHIND,
+        the change to the count is buffered as well, see PendingReactionDelta.
+
+        Returns the new number of reactions of this type on the post, 
+        or None if the post doesn't exist, the user cannot see it or the user is the author.
+        '''
+        if reaction_emoji not in SCORE_FOR_REACTION:
+            return None
+        if settings.REACTION_COUNTERS_WRITE_BEHIND:
+            query = TOGGLE_REACTION + BUFFER_REACTION
+        else:
+            query = TOGGLE_REACTION + APPLY_REACTION
+        with connection.cursor() as c:
+            c.execute(query, {
+                "post_id": post_id, 
+                "user_id": user.id, 
+                "reaction": reaction_emoji, 
+                "score": SCORE_FOR_REACTION[reaction_emoji],
+                "open": Group.OPEN,
+            })
+            row = c.fetchone()
+        return row[0] if row else None
+
+    def _comments_with_read_state(self, post_id, user):
+        comment_lastseen = ThreadCursor.objects.seen_subquery(user, int(post_id), OuterRef('post__group'))
+        return Comment.objects\
+            .filter(is_deleted=False)\
+            .annotate(is_read=Case(
+                When(submission_time__lte=comment_lastseen, then=True),
+                default=False, output_field=models.BooleanField()))
+
+    def _thread_with_read_state(self, post_id, user):
+        '''Queryset of the post and its child posts that the user can see, annotated with the user's read state
+
+        The user's own reactions on all the posts are prefetched in one query, see _split_thread.
+        Every post in the thread shares the same lastseen_timestamp, see ThreadCursor.
+        '''
+        lastseen = ThreadCursor.objects.seen_subquery(user, int(post_id), OuterRef('group'))
+        unread_comments = Comment.objects.only('id')\
+            .filter(post=OuterRef('pk'), is_deleted=False, submission_time__gt=OuterRef('lastseen_timestamp'))
+        return self.for_user(user)\
+            .annotate(lastseen_timestamp=lastseen)\
+            .annotate(my_subscription=Subquery(PostSubscribtion.objects.filter(post=OuterRef('pk'), user=user).only('notify_on').values('notify_on')[:1]))\
+            .annotate(is_read=Case(
+                When(last_modified__lte=F('lastseen_timestamp'), then=True),
+                default=False, output_field=models.BooleanField()))\
+            .annotate(has_unread_children=Case(
+                When(lastseen_timestamp=None, then=True),
+                When(last_activity__gt=F('lastseen_timestamp'), then=True),
+                When(Exists(unread_comments), then=True),
+                default=False, output_field=models.BooleanField()))\
+            .prefetch_related(Prefetch("reactions", 
+                queryset=Reaction.objects.filter(author=user).only('post', 'reaction'), to_attr="user_reactions"))\
+            .filter(Q(pk=post_id) | Q(parent_post_id=post_id))\
+            .order_by(F('parent_post_id').asc(nulls_first=True), 'submission_time')
+
+    def _split_thread(self, post_id, posts):
+        if not posts or posts[0].id != int(post_id):
+            raise Post.DoesNotExist("Post matching query does not exist.")
+        parent_post = posts[0]
+        child_posts = posts[1:]
+
+        PendingReactionDelta.objects.merge_into(posts)
+        for post in posts:
             # For the time being, add an upvotes field so that the UI doesn't have to change
-            if '👍' in post.reaction_summary:
-                post.upvotes = post.reaction_summary['👍']
-            else:
-                post.upvotes = 0
-            if post.lastseen_timestamp is None:
-                post.is_read = False
-                post.has_unread_children = True
-                continue
-            
-            if post.last_modified > post.lastseen_timestamp:
-                post.is_read = False
-            else:
-                post.is_read = True
-            
-            if post.last_activity > post.lastseen_timestamp:
-                post.has_unread_children = True
-            else:   
-                post.has_unread_children = False
-            
-            for comment in post.comments.all():
-                if not post.lastseen_timestamp:
-                    comment.is_read = False
-                    post.has_unread_children = True
-                elif comment.submission_time > post.lastseen_timestamp:
-                    comment.is_read = False
-                    post.has_unread_children = True
-                else:
-                    comment.is_read = True
-        
+            post.upvotes = post.reaction_summary.get('👍', 0)
+            # Emojis the user has reacted with, so the UI can show them as toggled on
+            post.my_reactions = [r.reaction for r in post.user_reactions]
+
         for post in child_posts:
             if not post.is_read or post.has_unread_children:
                 parent_post.has_unread_children = True
         
         return (parent_post, child_posts)
 
-    def get_post_list(self, user, tag=None, group=None, sort_by='recentposts'):
+    def get_post_details(self, post_id, user):
+        '''Loads a thread - the post, its child posts and their comments - along with the user's read state
+
+        Read state is computed in the database, so the number of queries and the work done 
+        in python stays the same regardless of the number of responses in the thread.
+        One query loads the post and child posts, and one query each loads comments, tags 
+        and the user's reactions.
+
+        Raises Post.DoesNotExist if the post does not exist or the user cannot see it.
+        '''
+        comments = self._comments_with_read_state(post_id, user)\
+            .select_related("author")\
+            .order_by('submission_time')
+
+        posts = list(self._thread_with_read_state(post_id, user)\
+            .select_related("author")\
+            .select_related("group")\
+            .prefetch_related(Prefetch("comments", queryset=comments))\
+            .prefetch_related("tags"))
+        parent_post, child_posts = self._split_thread(post_id, posts)
+
+        # When the post or its own comments last changed, ignoring activity in the child posts.
+        # main.js orders posts by it to work out how far the user has read, see partials/thread.html
+        parent_post.own_activity = max([parent_post.last_modified] + [c.last_modified for c in parent_post.comments.all()])
+        for post in child_posts:
+            post.own_activity = max(post.last_modified, post.last_activity)
+        return (parent_post, child_posts)
+
+    def get_thread_state(self, post_id, user):
+        '''Like get_post_details, but only loads what changes between users or between reactions
+
+        Skips html, authors, comments and tags - i.e. everything in the rendered thread fragment, 
+        see views.render_thread. Returns (parent_post, child_posts, unread_comment_ids). 
+        '''
+        posts = list(self._thread_with_read_state(post_id, user)\
+            .select_related("group")\
+            .only('title', 'slug', 'post_type', 'parent_post', 'last_modified', 'last_activity', 
+                'reaction_summary', 'group', 'group__name'))
+        parent_post, child_posts = self._split_thread(post_id, posts)
+
+        # Unread comments can only exist under posts that have unread children
+        with_unread_children = [post.id for post in posts if post.has_unread_children]
+        unread_comment_ids = []
+        if with_unread_children:
+            unread_comments = Comment.objects.filter(post_id__in=with_unread_children, is_deleted=False)
+            if parent_post.lastseen_timestamp:
+                unread_comments = unread_comments.filter(submission_time__gt=parent_post.lastseen_timestamp)
+            unread_comment_ids = list(unread_comments.values_list('id', flat=True))
+        return (parent_post, child_posts, unread_comment_ids)
+
+    def get_thread_changes(self, post_id, user, since):
+        '''Posts and comments in a thread that were created, edited or deleted after `since`
+
+        Returns (posts, comments), or raises Post.DoesNotExist if the user cannot see the thread.
+        Deleted posts and comments are included, so that clients can remove them.
+        Callers must not expose their content, see views.thread_changes.
+        '''
+        thread = self.for_user(user).filter(Q(pk=post_id) | Q(parent_post_id=post_id))
+        if not thread.filter(pk=post_id, parent_post=None).exists():
+            raise Post.DoesNotExist("Post matching query does not exist.")
+
+        posts = list(thread\
+            .select_related("author")\
+            .filter(Q(submission_time__gt=since) | Q(last_modified__gt=since))\
+            .order_by('submission_time'))
+        comments = list(Comment.objects\
+            .select_related("author")\
+            .filter(Q(post_id=post_id) | Q(post__parent_post_id=post_id))\
+            .filter(Q(submission_time__gt=since) | Q(last_modified__gt=since))\
+            .order_by('submission_time'))
+        return (posts, comments)
+
+    def get_feed_changes(self, user, since, tag=None, group=None):
+        '''Top level posts in a feed with new activity after `since`, most recent first
+
+        At most POSTS_PER_PAGE posts are returned, a client that gets a full page should reload the feed.
+        '''
+        if not group and not tag:
+            entries = InboxEntry.objects\
+                .select_related('post', 'post__author', 'post__group')\
+                .only('post', 'last_activity', *['post__' + f for f in Post.LIST_FIELDS])\
+                .filter(user=user, last_activity__gt=since)\
+                .order_by('-last_activity', '-post_id')[:POSTS_PER_PAGE]
+            return [entry.post for entry in entries]
+
         posts = Post.objects\
             .select_related('author')\
             .select_related('group')\
-            .annotate(lastseen_timestamp=Subquery(LastSeenOnPost.objects.filter(post=OuterRef('pk'), user=user).only('seen').values('seen')[:1]))\
-            .filter(
-                Q(Exists(GroupMember.objects.only('id').filter(group=OuterRef('group'), user=user))) | Q(group__group_type=Group.OPEN), 
-                parent_post=None
-            )
+            .only(*Post.LIST_FIELDS)\
+            .filter(group_id__in=Group.objects.visible_group_ids(user), parent_post=None, last_activity__gt=since)
         if group:
             posts = posts.filter(group=group)
         if tag:
             posts = posts.filter(Q(Exists(PostTag.objects.only('id').filter(post=OuterRef('pk'), tag=tag))))
+        return list(posts.order_by('-last_activity', '-id')[:POSTS_PER_PAGE])
+
+    def get_feed_version(self, user, tag=None, group=None):
+        '''Cheap validator for a feed - changes whenever get_post_list could return different posts or read state
+
+        Returns (last_change, num_posts, post_ids_sum, last_seen, num_seen, seen_sum).
+        last_change covers new activity and edits. post_ids_sum changes when a post joins or leaves the feed,
+        for example when a tag moves from one post to another. seen_sum changes on every write to the 
+        user's read state, including cursors that move forward but stay behind the newest one.
+        The timestamps can be None if the feed is empty or the user hasn't read anything.
+        '''
+        feed_columns = "GREATEST(max(p.last_activity), max(p.last_modified)), count(*), sum(p.id)"
+        if not group and not tag:
+            feed_query = "SELECT " + feed_columns + """ FROM inbox i JOIN posts p on p.id = i.post_id 
+                WHERE i.user_id = %s"""
+            params = [user.id]
+        elif group:
+            feed_query = "SELECT " + feed_columns + """ FROM posts p 
+                WHERE p.group_id = %s AND p.parent_post_id is null"""
+            params = [group.id]
+        else:
+            feed_query = "SELECT " + feed_columns + """ FROM posts p JOIN post_tags pt on pt.post_id = p.id
+                WHERE pt.tag_id = %s AND p.parent_post_id is null AND p.group_id = ANY(%s)"""
+            params = [tag.id, Group.objects.visible_group_ids(user)]
+        
+        # Every write moves seen forward, or deletes a pending row, so the sum of the timestamps always changes
+        # Summed as microseconds, because a sum of floats would lose the small moves
+        seen_columns = "max(seen), count(*), sum((extract(epoch from seen) * 1000000)::bigint)"
+        seen_query = "SELECT " + seen_columns + """ FROM thread_cursors WHERE user_id = %s
+            UNION ALL SELECT """ + seen_columns + " FROM group_watermarks WHERE user_id = %s"
+        params = params + [user.id, user.id]
+        pending = ThreadCursor.objects.pending(user)
+        if pending:
+            seen_query += " UNION ALL SELECT " + seen_columns + """ 
+                FROM unnest(%s::int[], %s::timestamptz[]) pending(post_id, seen)"""
+            params = params + [list(pending.keys()), list(pending.values())]
 
+        with connection.cursor() as c:
+            c.execute("""
+                SELECT feed.*, seen.* FROM (""" + feed_query + """) feed, 
+                    (SELECT max(max), sum(count)::bigint, sum(sum) FROM (""" + seen_query + """) s) seen
+            """, params)
+            return c.fetchone()
+
+    def get_post_list(self, user, tag=None, group=None, sort_by='recentposts', before=None, unread_only=False):
+        '''Returns a page of top level posts, and a cursor to fetch the next (older) page
+
+        Pagination uses the sort key (timestamp, id) of the last post on the page, 
+        instead of an offset. This way, the cost of fetching a page does not depend on 
+        how deep the user has scrolled, or how many posts exist in the database.
+
+        The home page (no group and no tag) is read from the user's inbox, 
+        which only contains posts the user can see. See InboxEntry.
+
+        :param before: the cursor returned by a previous call, or None for the first page
+        :param unread_only: only return threads with activity the user hasn't seen. 
+            The filter runs in the database, so pages are still full and the cursor still works
+        :return: (posts, next_cursor). next_cursor is None if there are no older posts
+        '''
         if sort_by == 'recentposts':
-            posts = posts.order_by("-submission_time")
+            sort_field = 'submission_time'
         else:
-            posts = posts.order_by("-last_activity")
-        
+            sort_field = 'last_activity'
+
+        if not group and not tag:
+            entries = InboxEntry.objects\
+                .select_related('post', 'post__author', 'post__group')\
+                .only('post', sort_field, *['post__' + f for f in Post.LIST_FIELDS])\
+                .annotate(lastseen_timestamp=ThreadCursor.objects.seen_subquery(user, OuterRef('post'), OuterRef('group')))\
+                .filter(user=user)
+            if unread_only:
+                entries = entries.filter(ThreadCursor.objects.unread_filter(user, OuterRef('post'), OuterRef('group'), OuterRef('last_activity')))
+            entries, next_cursor = _keyset_page(entries, sort_field, 'post_id', before)
+            posts = []
+            for entry in entries:
+                entry.post.lastseen_timestamp = entry.lastseen_timestamp
+                posts.append(entry.post)
+        else:
+            # Only load the columns the feed displays. 
+            # In particular, skip html and reaction_summary, which are large
+            posts = Post.objects\
+                .select_related('author')\
+                .select_related('group')\
+                .only(*Post.LIST_FIELDS)\
+                .annotate(lastseen_timestamp=ThreadCursor.objects.seen_subquery(user, OuterRef('pk'), OuterRef('group')))\
+                .filter(group_id__in=Group.objects.visible_group_ids(user), parent_post=None)
+            if group:
+                posts = posts.filter(group=group)
+            if tag:
+                posts = posts.filter(Q(Exists(PostTag.objects.only('id').filter(post=OuterRef('pk'), tag=tag))))
+            if unread_only:
+                posts = posts.filter(ThreadCursor.objects.unread_filter(user, OuterRef('pk'), OuterRef('group'), OuterRef('last_activity')))
+            posts, next_cursor = _keyset_page(posts, sort_field, 'id', before)
+
         for post in posts:
             if post.lastseen_timestamp is None:
                 post.is_read = False
@@ -442,7 +888,7 @@ class PostsManager(models.Manager):
                 post.is_read = False
             else:
                 post.is_read = True
-        return posts
+        return (posts, next_cursor)
 
     def vote_type_to_string(self, vote_type):
         mapping = {
@@ -491,7 +937,22 @@ class Post(models.Model):
         index_together = [
             ["submission_time",],
         ]
+        # Feeds only show top level posts, newest first. See PostsManager.get_post_list
+        # id is the tie breaker used by keyset pagination
+        indexes = [
+            models.Index(name="posts_feed_last_activity", fields=['-last_activity', '-id'], condition=Q(parent_post=None)),
+            models.Index(name="posts_feed_submission_time", fields=['-submission_time', '-id'], condition=Q(parent_post=None)),
+            models.Index(name="posts_group_last_activity", fields=['group', '-last_activity', '-id'], condition=Q(parent_post=None)),
+            models.Index(name="posts_group_submission_time", fields=['group', '-submission_time', '-id'], condition=Q(parent_post=None)),
+        ]
     
+    # Columns needed to render a post in a feed, see PostsManager.get_post_list
+    LIST_FIELDS = (
+        'title', 'slug', 'excerpt', 'submission_time', 'last_activity',
+        'author', 'author__username', 'author__first_name', 'author__last_name', 'author__avatar',
+        'group', 'group__name',
+    )
+
     objects = PostsManager()
     group = models.ForeignKey(Group, on_delete=models.PROTECT)
     title = models.CharField(max_length=120, blank=True, null=True)
@@ -523,6 +984,8 @@ class Post(models.Model):
         ),
         default=DISCUSSION)
     html = models.TextField(max_length=16384)
+    # Plain text summary of html, derived automatically when the post is saved
+    excerpt = models.CharField(max_length=EXCERPT_LENGTH, blank=True, default='')
     is_deleted = models.BooleanField(default=False)
     sticky = models.BooleanField(default=False)
     accepted_answer = models.BooleanField(default=False)
@@ -530,10 +993,10 @@ class Post(models.Model):
     num_comments = models.IntegerField(default=0)
     reaction_summary = JSONField(default=dict)
     score = models.IntegerField(default=0)
-    last_seen = models.ManyToManyField(User, through='LastSeenOnPost', related_name='last_seen')
     tags = models.ManyToManyField('Tag', through='PostTag', related_name='posts', blank=True)
     subscriptions = models.ManyToManyField(User, through='PostSubscribtion', related_name='subscriptions', blank=True)
 
+    @transaction.atomic
     def new_child_post(self, author, post):
         post.author = author
         post.parent_post = self
@@ -545,6 +1008,7 @@ class Post(models.Model):
 
         self.last_activity = now
         self.save(update_fields=["last_activity"])
+        InboxEntry.objects.touch(self.id, now)
 
         self._send_new_child_post_notifications(post)
         PostSubscribtion.objects.subscribe(self, author, PostSubscribtion.REPLIES_ONLY)
@@ -566,33 +1030,16 @@ class Post(models.Model):
             "link_title": "View Response"
         }
 
-        for subscription in PostSubscribtion.objects.filter(post=self).all():
-            # If user hasn't added charcha bot, skip notification
-            if not subscription.user.gchat_space:
-                continue
-            
-            # If users have a @mention in the post, they would have already received a notification
-            # So do not send another notification
-            if subscription.user.id in already_notified_users:
-                continue
-
-            # Don't send notifications to the author
-            if subscription.user == post.author:
-                continue
-
-            send_notification = False
-
-            # Send notification to users who have subscribed to all notifications or new posts
-            if subscription.notify_on in (PostSubscribtion.ALL_NOTIFICATIONS, PostSubscribtion.NEW_POSTS_AND_REPLIES_ONLY):
-                send_notification = True
-            # If user preference is REPLIES_ONLY, then check if this user is the author of the parent post
-            elif subscription.notify_on in (PostSubscribtion.REPLIES_ONLY, ):
-                if subscription.user == self.author:
-                    send_notification = True
-            
-            if send_notification:
-                space_id = subscription.user.gchat_space
-                notify_space(space_id, event)
+        # Users who have subscribed to all notifications or new posts are notified,
+        # users who have subscribed to replies only are notified if they are the author of the parent post.
+        # Users who were @mentioned in the post have already received a notification, 
+        # and the author doesn't need one
+        space_ids = PostSubscribtion.objects.spaces_to_notify(self, 
+            everyone=(PostSubscribtion.ALL_NOTIFICATIONS, PostSubscribtion.NEW_POSTS_AND_REPLIES_ONLY),
+            replies=(PostSubscribtion.REPLIES_ONLY, ), replied_to=self.author,
+            exclude=set(already_notified_users) | {post.author.id})
+        for space_id in space_ids:
+            OutboxMessage.objects.enqueue(space_id, event, thread=self, kind='response')
 
 
     def upvote(self, user):
@@ -603,46 +1050,19 @@ class Post(models.Model):
         return self.react(user, '👎')
 
     def react(self, user, reaction_emoji):
-        SCORE_FOR_REACTION = {
-            '👍': 1,
-            '👎': -1,
-            '😀': 1,
-        }
-        if reaction_emoji not in SCORE_FOR_REACTION:
-            return
-
         if self._voting_for_myself(user):
             return
-        
-        score_delta = SCORE_FOR_REACTION[reaction_emoji]
-
-        # If this user had previously reacted on this post, then "undo" the reaction by deleting it
-        num_rows, _ = Reaction.objects.filter(post=self, author=user, reaction=reaction_emoji).delete()
-        if num_rows > 0:
-            # The user had previously reacted on this post..
-            score_delta = score_delta * -1
-        else:
-            Reaction.objects.create(post=self, author=user, reaction=reaction_emoji)
-        
-        # This does have a race condition, but it is fine for now.
-        if reaction_emoji in self.reaction_summary:
-            self.reaction_summary[reaction_emoji] += score_delta
-        else:
-            self.reaction_summary[reaction_emoji] = score_delta
-        self.save(update_fields=["reaction_summary"])
-
-        # Increment/Decrement the score of author
-        self.author.score = F('score') + score_delta
-        self.author.save(update_fields=["score"])
-
-        self.refresh_from_db(fields=['reaction_summary'])
-        return self.reaction_summary[reaction_emoji]
+        return Post.objects.react(self.id, user, reaction_emoji)
 
     def _voting_for_myself(self, user):
         return self.author.id == user.id
 
     def save(self, *args, **kwargs):
         self.html = clean_and_normalize_html(self.html)
+        self.excerpt = make_excerpt(self.html)
+        update_fields = kwargs.get('update_fields', None)
+        if update_fields and 'html' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'excerpt'}
         is_create = False
         if not self.pk:
             is_create = True
@@ -658,7 +1078,9 @@ class Post(models.Model):
         if self.parent_post:
             self.parent_post.last_activity = now
             self.parent_post.save(update_fields=["last_activity"])
+            InboxEntry.objects.touch(self.parent_post.id, now)
 
+    @transaction.atomic
     def add_comment(self, html, author):
         now = timezone.now()
 
@@ -681,6 +1103,7 @@ class Post(models.Model):
             parent_post = self.parent_post
         else:
             parent_post = self
+        InboxEntry.objects.touch(parent_post.id, now)
 
         self._send_notifications_on_new_comment(parent_post, comment)
         
@@ -701,33 +1124,16 @@ class Post(models.Model):
             "link_title": "View Comment"
         }
         
-        for subscription in PostSubscribtion.objects.filter(post=parent_post).all():
-            # If user hasn't added charcha bot, skip notification
-            if not subscription.user.gchat_space:
-                continue
-
-            # If users have a @mention in the comment, they would have already received a notification
-            # So do not send another notification
-            if subscription.user.id in already_notified_users:
-                continue
-
-            # Don't send notifications to the author
-            if subscription.user == comment.author:
-                continue
-
-            send_notification = False
-
-            # Send notification to users who have subscribed to all notifications or new posts
-            if subscription.notify_on in (PostSubscribtion.ALL_NOTIFICATIONS, ):
-                send_notification = True
-            # If user preference is REPLIES_ONLY, then check if this user is the author of the post to which this comment is being added
-            elif subscription.notify_on in (PostSubscribtion.REPLIES_ONLY, PostSubscribtion.NEW_POSTS_AND_REPLIES_ONLY):
-                if subscription.user == self.author:
-                    send_notification = True
-            
-            if send_notification:
-                space_id = subscription.user.gchat_space
-                notify_space(space_id, event)
+        # Users who have subscribed to all notifications are notified, users who have subscribed 
+        # to replies only are notified if they are the author of the post to which this comment is being added.
+        # Users who were @mentioned in the comment have already received a notification, 
+        # and the author doesn't need one
+        space_ids = PostSubscribtion.objects.spaces_to_notify(parent_post, 
+            everyone=(PostSubscribtion.ALL_NOTIFICATIONS, ),
+            replies=(PostSubscribtion.REPLIES_ONLY, PostSubscribtion.NEW_POSTS_AND_REPLIES_ONLY), replied_to=self.author,
+            exclude=set(already_notified_users) | {comment.author.id})
+        for space_id in space_ids:
+            OutboxMessage.objects.enqueue(space_id, event, thread=parent_post, kind='comment')
 
     def __str__(self):
         if self.title:
@@ -740,8 +1146,9 @@ class Post(models.Model):
 class Reaction(models.Model):
     class Meta:
         db_table = "reactions"
-        index_together = [
-            ["post", "author"],
+        constraints = [
+            # Also serves lookups by (post, author)
+            models.UniqueConstraint(name="reactions_unique_post_author_reaction", fields=['post', 'author', 'reaction'])
         ]
 
     post = models.ForeignKey(Post, on_delete=models.PROTECT, related_name='reactions')
@@ -750,6 +1157,163 @@ class Reaction(models.Model):
     reaction = models.CharField(max_length=1)
     submission_time = models.DateTimeField(auto_now_add=True)
 
+class PendingReactionDeltaManager(models.Manager):
+    def merge_into(self, posts):
+        '''Adds pending deltas to reaction_summary of the given posts, so readers see up to date counts
+
+        The counters are read again, in the same statement as the deltas. 
+        Otherwise a flush that commits in between would leave the deltas out of both.
+        '''
+        if not settings.REACTION_COUNTERS_WRITE_BEHIND or not posts:
+            return
+        posts_by_id = {post.id: post for post in posts}
+        with connection.cursor() as c:
+            c.execute("""
+                SELECT p.id, p.reaction_summary, (
+                    SELECT jsonb_object_agg(d.reaction, d.delta) FROM (
+                        SELECT reaction, sum(delta) as delta FROM pending_reaction_deltas 
+                        WHERE post_id = p.id GROUP BY reaction) d
+                ) FROM posts p WHERE p.id = ANY(%s)
+            """, [list(posts_by_id.keys())])
+            for post_id, summary, deltas in c.fetchall():
+                summary = summary or {}
+                for reaction, delta in (deltas or {}).items():
+                    summary[reaction] = summary.get(reaction, 0) + delta
+                posts_by_id[post_id].reaction_summary = summary
+
+    def flush(self):
+        '''Applies all pending deltas to posts.reaction_summary, and deletes them
+
+        Runs as one statement, so readers either see the old counts plus the pending deltas,
+        or the new counts and no pending deltas. Deltas inserted while the flush is running 
+        are left for the next flush. Returns (deltas, posts) - the number of rows flushed and updated.
+        '''
+        with connection.cursor() as c:
+            c.execute("""
+                WITH flushed AS (
+                    DELETE FROM pending_reaction_deltas
+                    RETURNING post_id, reaction, delta
+                ), post_deltas AS (
+                    SELECT post_id, jsonb_object_agg(reaction, delta) as deltas
+                    FROM (SELECT post_id, reaction, sum(delta) as delta 
+                        FROM flushed GROUP BY post_id, reaction) per_reaction
+                    GROUP BY post_id
+                ), updated_posts AS (
+                    UPDATE posts p SET reaction_summary = (
+                        SELECT jsonb_object_agg(k.key, 
+                            COALESCE((p.reaction_summary->>k.key)::int, 0) + COALESCE((pd.deltas->>k.key)::int, 0))
+                        FROM (SELECT jsonb_object_keys(p.reaction_summary) 
+                            UNION SELECT jsonb_object_keys(pd.deltas)) k(key)
+                    )
+                    FROM post_deltas pd
+                    WHERE p.id = pd.post_id
+                    RETURNING p.id
+                )
+                SELECT (SELECT count(*) FROM flushed), (SELECT count(*) FROM updated_posts)
+            """)
+            return c.fetchone()
+
+class PendingReactionDelta(models.Model):
+    '''Changes to reaction counts that haven't been applied yet
+
+    Only used when settings.REACTION_COUNTERS_WRITE_BEHIND is on. Every reaction on a popular post 
+    would otherwise update the same posts row, and wait on each other's row locks.
+    Instead, reactions append a row here, and `python manage.py flush_reaction_counters` 
+    periodically applies the deltas in a batch. Readers add pending deltas to what they read.
+    '''
+    class Meta:
+        db_table = "pending_reaction_deltas"
+
+    objects = PendingReactionDeltaManager()
+    post = models.ForeignKey(Post, on_delete=models.PROTECT, related_name='+')
+    reaction = models.CharField(max_length=1)
+    # Change in the number of reactions of this type on the post
+    delta = models.IntegerField()
+
+SCORE_CACHE_TIMEOUT = 60
+
+def _score_key(user_id):
+    return "score:%s" % user_id
+
+class ScoreLedgerManager(models.Manager):
+    def current_score(self, user):
+        '''users.score plus the changes that haven't been rolled up yet
+
+        Cached for SCORE_CACHE_TIMEOUT seconds, so a new reaction can take that long to show up.
+        Rolling up doesn't change the result, so roll_up doesn't need to invalidate the cache.
+        '''
+        key = _score_key(user.id)
+        score = cache.get(key)
+        if score is None:
+            with connection.cursor() as c:
+                c.execute("""SELECT u.score + COALESCE((SELECT sum(s.delta) FROM score_ledger s 
+                        WHERE s.user_id = u.id AND NOT s.rolled_up), 0)
+                    FROM users u WHERE u.id = %s""", [user.id])
+                score = c.fetchone()[0]
+            cache.set(key, score, SCORE_CACHE_TIMEOUT)
+        return score
+
+    def by_period(self, user, kind='month'):
+        '''Score changes for the user grouped by day, week, month or year, oldest first
+
+        Only covers changes recorded since the ledger was introduced.
+        '''
+        return self.filter(user=user)\
+            .annotate(period=Trunc('created', kind))\
+            .values_list('period')\
+            .annotate(score=models.Sum('delta'))\
+            .order_by('period')
+
+    def roll_up(self):
+        '''Adds all new entries in the ledger to users.score
+
+        The entries are only marked as rolled up, never deleted.
+        Entries inserted by transactions that haven't committed yet are left for the next run.
+        Returns (entries, users) - the number of entries rolled up and users updated.
+        '''
+        with connection.cursor() as c:
+            c.execute("""
+                WITH rolled_up AS (
+                    UPDATE score_ledger SET rolled_up = true 
+                    WHERE NOT rolled_up
+                    RETURNING user_id, delta
+                ), updated_users AS (
+                    UPDATE users u SET score = u.score + s.delta
+                    FROM (SELECT user_id, sum(delta) as delta FROM rolled_up GROUP BY user_id) s
+                    WHERE u.id = s.user_id AND s.delta <> 0
+                    RETURNING u.id
+                )
+                SELECT (SELECT count(*) FROM rolled_up), (SELECT count(*) FROM updated_users)
+            """)
+            return c.fetchone()
+
+class ScoreChange(models.Model):
+    '''Append-only ledger of changes to users' scores
+
+    Reactions append a row here instead of updating users.score, so votes on posts by the same 
+    author don't wait on the author's row lock. `python manage.py aggregate_scores` periodically 
+    rolls new entries into users.score, see ScoreLedgerManager.roll_up. 
+    Use ScoreChange.objects.current_score to read a score that includes the latest changes.
+    '''
+    class Meta:
+        db_table = "score_ledger"
+        indexes = [
+            models.Index(name="score_ledger_user_created", fields=['user', 'created']),
+            # roll_up and current_score only look at entries that haven't been rolled up
+            models.Index(name="score_ledger_pending", fields=['user'], condition=Q(rolled_up=False)),
+        ]
+
+    objects = ScoreLedgerManager()
+    # score_ledger_user_created serves lookups by user
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='+', db_index=False)
+    # The post and reaction that caused the change
+    post = models.ForeignKey(Post, on_delete=models.PROTECT, related_name='+', null=True)
+    reaction = models.CharField(max_length=1, blank=True)
+    delta = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    # Whether delta has been added to users.score
+    rolled_up = models.BooleanField(default=False)
+
 class PostMembers(models.Model):
     'Only in case you want to share a post with someone who is a guest in the group'
     class Meta:
@@ -761,7 +1325,7 @@ class PostMembers(models.Model):
 class CommentsManager(models.Manager):
     def for_user(self, user):
         return Comment.objects\
-            .filter(Q(Exists(GroupMember.objects.only('id').filter(group=OuterRef('post__group'), user=user))) | Q(post__group__group_type=Group.OPEN))\
+            .filter(post__group_id__in=Group.objects.visible_group_ids(user))\
             .filter(is_deleted=False)
 
 class Comment(models.Model):
@@ -792,6 +1356,9 @@ class Comment(models.Model):
         if self.post.parent_post:
             self.post.parent_post.last_activity = now
             self.post.parent_post.save(update_fields=["last_activity"])
+            InboxEntry.objects.touch(self.post.parent_post.id, now)
+        else:
+            InboxEntry.objects.touch(self.post.id, now)
 
         return self
 
@@ -808,25 +1375,541 @@ class Favourite(models.Model):
     favourited_on = models.DateTimeField(auto_now_add=True)
     is_deleted = models.BooleanField(default=False)
 
-class LastSeenOnPostManager(models.Manager):
+# With settings.LAST_SEEN_WRITE_BEHIND, thread cursors are buffered in the cache, 
+# and `python manage.py flush_last_seen` writes them to thread_cursors in bulk. 
+# Read tracking adds up to more writes than everything else, and most of them are the same user 
+# reading the same thread again. The buffer is split into generations of settings.LAST_SEEN_FLUSH_INTERVAL seconds:
+#   last_seen:<generation>:<user id> is {thread id: seen} for the cursors the user moved in that generation
+#   last_seen:<generation>:count and last_seen:<generation>:user:<n> list those users, for the flush
+# Readers merge the last LAST_SEEN_GENERATIONS generations, the flush writes the ones before them.
+# So the flush must run at least every LAST_SEEN_FLUSH_INTERVAL seconds, 
+# or recently read threads show as unread until it catches up.
+# Buffered cursors that are evicted from the cache are lost, and those threads show as unread again.
+LAST_SEEN_GENERATIONS = 3
+
+# Buffered cursors that were never flushed are dropped after this many seconds
+LAST_SEEN_BUFFER_TIMEOUT = 24 * 60 * 60
+
+def _last_seen_generation():
+    return int(timezone.now().timestamp()) // settings.LAST_SEEN_FLUSH_INTERVAL
+
+def _last_seen_key(generation, user_id):
+    return "last_seen:%d:%d" % (generation, user_id)
+
+class PendingSeen(models.Expression):
+    '''When the user last saw a thread according to the buffered cursors, see ThreadCursorManager.pending
+
+    The cursors are passed to postgres as two arrays. thread is a thread id, or an OuterRef 
+    to a column of the queryset the expression is used in
+    '''
+    template = "(SELECT pending.seen FROM unnest(%%s::int[], %%s::timestamptz[]) pending(id, seen) WHERE pending.id = %(thread)s)"
+    output_field = models.DateTimeField()
+
+    def __init__(self, pending, thread, **kwargs):
+        super().__init__(**kwargs)
+        self.pending = pending
+        self.expressions = [self._as_expression(thread)]
+
+    def _as_expression(self, value):
+        if isinstance(value, OuterRef):
+            return F(value.name)
+        if hasattr(value, 'resolve_expression'):
+            return value
+        return Value(value)
+
+    def get_source_expressions(self):
+        return self.expressions
+
+    def set_source_expressions(self, expressions):
+        self.expressions = expressions
+
+    def as_sql(self, compiler, connection):
+        names = ["thread", "last_activity"]
+        sqls, params = {}, [list(self.pending.keys()), list(self.pending.values())]
+        for name, expression in zip(names, self.expressions):
+            sqls[name], expression_params = compiler.compile(expression)
+            params.extend(expression_params)
+        return self.template % sqls, params
+
+class NotSeenInPending(PendingSeen):
+    'Matches threads that have no buffered cursor at or after last_activity'
+    template = """NOT EXISTS (SELECT 'x' FROM unnest(%%s::int[], %%s::timestamptz[]) pending(id, seen) 
+        WHERE pending.id = %(thread)s AND pending.seen >= %(last_activity)s)"""
+    output_field = models.BooleanField()
+
+    def __init__(self, pending, thread, last_activity, **kwargs):
+        super().__init__(pending, thread, **kwargs)
+        self.expressions.append(self._as_expression(last_activity))
+
+class ThreadCursorManager(models.Manager):
     def upsert(self, user, post_id, timestamp):
-        post = Post.objects.for_user(user).get(pk=post_id)
-        LastSeenOnPost.objects.update_or_create(user=user, post=post, defaults={'seen': timestamp})
+        if not self.upsert_many(user, [post_id], timestamp):
+            raise Post.DoesNotExist("Post matching query does not exist.")
+
+    def upsert_many(self, user, post_ids, timestamp):
+        '''Records that the user has seen the threads of the posts as of timestamp, in a single statement
+
+        post_ids can be top level posts or child posts, a child post moves the cursor of its thread.
+        Posts the user cannot see are skipped. seen only moves forward, 
+        so a late request with an older timestamp cannot mark threads as unread again.
+        With settings.LAST_SEEN_WRITE_BEHIND, the cursors are buffered in the cache instead,
+        and the statement only reads posts, see buffer. Returns the ids of the threads.
+        '''
+        visible = """
+            SELECT DISTINCT COALESCE(p.parent_post_id, p.id) as id FROM posts p
+            WHERE p.id = ANY(%(post_ids)s::int[]) AND p.group_id = ANY(%(group_ids)s::int[])
+        """
+        if settings.LAST_SEEN_WRITE_BEHIND:
+            query = visible
+        else:
+            query = """
+                WITH visible AS (""" + visible + """), upserted AS (
+                    INSERT INTO thread_cursors as tc (user_id, post_id, seen)
+                    SELECT %(user_id)s, visible.id, %(seen)s FROM visible
+                    ON CONFLICT (user_id, post_id) DO UPDATE 
+                    SET seen = EXCLUDED.seen
+                    WHERE tc.seen < EXCLUDED.seen
+                )
+                SELECT id FROM visible
+            """
+        with connection.cursor() as c:
+            c.execute(query, {
+                "post_ids": list(post_ids), 
+                "group_ids": list(Group.objects.visible_group_ids(user)),
+                "user_id": user.id, 
+                "seen": timestamp,
+            })
+            thread_ids = [row[0] for row in c.fetchall()]
+        if settings.LAST_SEEN_WRITE_BEHIND and thread_ids:
+            self.buffer(user, thread_ids, timestamp)
+        return thread_ids
+
+    def buffer(self, user, thread_ids, timestamp):
+        '''Adds cursors to the user's entry in the current generation of the cache, see LAST_SEEN_GENERATIONS
+
+        Repeated reads of a thread collapse into one cursor with the latest timestamp. 
+        The entry is read and written back, so two requests of the same user at the same instant 
+        can lose a cursor - the thread then shows as unread until it is read again.
+        '''
+        generation = _last_seen_generation()
+        key = _last_seen_key(generation, user.id)
+        entry = cache.get(key)
+        is_new = entry is None
+        entry = entry or {}
+        for thread_id in thread_ids:
+            if thread_id not in entry or entry[thread_id] < timestamp:
+                entry[thread_id] = timestamp
+        cache.set(key, entry, LAST_SEEN_BUFFER_TIMEOUT)
+        if is_new:
+            # Remember the user, so that flush can find the entry
+            count_key = "last_seen:%d:count" % generation
+            cache.add(count_key, 0, LAST_SEEN_BUFFER_TIMEOUT)
+            try:
+                n = cache.incr(count_key)
+            except ValueError:
+                # The count was evicted right after it was added. The entry is only seen by readers until it expires
+                return
+            cache.set("last_seen:%d:user:%d" % (generation, n), user.id, LAST_SEEN_BUFFER_TIMEOUT)
+
+    def pending(self, user):
+        '''The user's buffered cursors that may not be in thread_cursors yet, as {thread id: seen}
+
+        Always empty unless settings.LAST_SEEN_WRITE_BEHIND is on
+        '''
+        if not settings.LAST_SEEN_WRITE_BEHIND:
+            return {}
+        current = _last_seen_generation()
+        keys = [_last_seen_key(generation, user.id) 
+            for generation in range(current - LAST_SEEN_GENERATIONS + 1, current + 1)]
+        pending = {}
+        for entry in cache.get_many(keys).values():
+            for thread_id, seen in entry.items():
+                if thread_id not in pending or pending[thread_id] < seen:
+                    pending[thread_id] = seen
+        return pending
+
+    def mark_tag_read(self, user, tag, timestamp):
+        '''Marks every thread with the tag that the user can see as read as of timestamp, in one statement
+
+        A tag spans groups, so this moves thread cursors instead of group watermarks.
+        Threads that are already read are skipped, so that they don't get a cursor.
+        '''
+        with connection.cursor() as c:
+            c.execute("""
+                INSERT INTO thread_cursors as tc (user_id, post_id, seen)
+                SELECT %(user_id)s, p.id, %(seen)s
+                FROM posts p JOIN post_tags pt on pt.post_id = p.id
+                WHERE pt.tag_id = %(tag_id)s AND p.parent_post_id is null 
+                AND p.group_id = ANY(%(group_ids)s::int[])
+                AND NOT EXISTS (SELECT 'x' FROM group_watermarks gw 
+                    WHERE gw.user_id = %(user_id)s AND gw.group_id = p.group_id AND gw.seen >= p.last_activity)
+                ON CONFLICT (user_id, post_id) DO UPDATE 
+                SET seen = EXCLUDED.seen
+                WHERE tc.seen < EXCLUDED.seen
+            """, {
+                "user_id": user.id, 
+                "tag_id": tag.id, 
+                "group_ids": list(Group.objects.visible_group_ids(user)), 
+                "seen": timestamp,
+            })
+
+    def seen_subquery(self, user, thread, group):
+        '''Expression for when the user last saw the thread, or null if the user hasn't seen it
+
+        thread and group are the thread's top level post and group, either ids or OuterRefs.
+        Combines the thread's cursor with the group's watermark, and buffered cursors 
+        when settings.LAST_SEEN_WRITE_BEHIND is on.
+        '''
+        seen = Subquery(self.filter(post=thread, user=user).only('seen').values('seen')[:1])
+        watermark = Subquery(GroupWatermark.objects.filter(group=group, user=user).only('seen').values('seen')[:1])
+        # GREATEST ignores nulls in postgres
+        pending = self.pending(user)
+        if not pending:
+            return Greatest(seen, watermark)
+        return Greatest(seen, watermark, PendingSeen(pending, thread))
+
+    def unread_filter(self, user, thread, group, last_activity):
+        '''Q object that matches threads with activity after the user last saw them
+
+        Same rule as seen_subquery, but written as anti-joins against thread_cursors and group_watermarks,
+        so that postgres can probe their unique (user, post) and (user, group) indexes
+        instead of computing when the user last saw every thread.
+        '''
+        unread = ~Q(Exists(self.filter(post=thread, user=user, seen__gte=last_activity).only('id'))) \
+            & ~Q(Exists(GroupWatermark.objects.filter(group=group, user=user, seen__gte=last_activity).only('id')))
+        pending = self.pending(user)
+        if pending:
+            unread &= Q(NotSeenInPending(pending, thread, last_activity))
+        return unread
+
+    def flush(self):
+        '''Writes the cursors buffered in the cache to thread_cursors in one statement, see LAST_SEEN_GENERATIONS
+
+        Only flushes generations that ended at least LAST_SEEN_FLUSH_INTERVAL ago, 
+        so that no request is still adding to them. Returns (flushed, updated) - the number of 
+        buffered cursors, and the number of cursors that were inserted or moved forward
+        '''
+        last = _last_seen_generation() - LAST_SEEN_GENERATIONS + 1
+        generations = range(last - LAST_SEEN_BUFFER_TIMEOUT // settings.LAST_SEEN_FLUSH_INTERVAL, last + 1)
+        count_keys = {"last_seen:%d:count" % generation: generation for generation in generations}
+        user_keys = {}
+        for count_key, count in cache.get_many(count_keys.keys()).items():
+            generation = count_keys[count_key]
+            for n in range(1, count + 1):
+                user_keys["last_seen:%d:user:%d" % (generation, n)] = generation
+        entry_keys = {}
+        for user_key, user_id in cache.get_many(user_keys.keys()).items():
+            entry_keys[_last_seen_key(user_keys[user_key], user_id)] = user_id
+
+        user_ids, thread_ids, seens = [], [], []
+        for entry_key, entry in cache.get_many(entry_keys.keys()).items():
+            for thread_id, seen in entry.items():
+                user_ids.append(entry_keys[entry_key])
+                thread_ids.append(thread_id)
+                seens.append(seen)
+        updated = 0
+        if user_ids:
+            with connection.cursor() as c:
+                c.execute("""
+                    WITH upserted AS (
+                        INSERT INTO thread_cursors as tc (user_id, post_id, seen)
+                        SELECT user_id, post_id, max(seen) 
+                        FROM unnest(%s::int[], %s::int[], %s::timestamptz[]) pending(user_id, post_id, seen)
+                        GROUP BY user_id, post_id
+                        ON CONFLICT (user_id, post_id) DO UPDATE 
+                        SET seen = EXCLUDED.seen
+                        WHERE tc.seen < EXCLUDED.seen
+                        RETURNING 1
+                    )
+                    SELECT count(*) FROM upserted
+                """, [user_ids, thread_ids, seens])
+                updated = c.fetchone()[0]
+        cache.delete_many(list(count_keys) + list(user_keys) + list(entry_keys))
+        return (len(user_ids), updated)
+
+class ThreadCursor(models.Model):
+    '''When a user last read a thread - a top level post, its child posts and their comments
+
+    Anything in the thread created or modified after seen is unread.
+    Threads in a group can also be marked as read in bulk by a GroupWatermark. 
+    A user has one row per thread read, not one per post.
+    '''
+    class Meta:
+        db_table = "thread_cursors"
+        constraints = [
+            # Also serves lookups by (user, post)
+            models.UniqueConstraint(name="threadcursors_unique_user_post", fields=['user', 'post'])
+        ]
+    
+    objects = ThreadCursorManager()
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='+', db_index=False)
+    # The top level post of the thread
+    post = models.ForeignKey(Post, on_delete=models.PROTECT, related_name='+')
+    seen = models.DateTimeField()
+
+class GroupWatermarkManager(models.Manager):
+    def advance(self, user, group_ids, timestamp):
+        '''Marks every thread in the groups with no activity after timestamp as read, in one statement
+
+        Thread cursors that the watermarks make redundant are deleted
+        '''
+        with connection.cursor() as c:
+            c.execute("""
+                WITH watermark AS (
+                    INSERT INTO group_watermarks as gw (user_id, group_id, seen)
+                    SELECT %(user_id)s, g.id, %(seen)s FROM unnest(%(group_ids)s::int[]) g(id)
+                    ON CONFLICT (user_id, group_id) DO UPDATE 
+                    SET seen = GREATEST(gw.seen, EXCLUDED.seen)
+                    RETURNING group_id, seen
+                )
+                DELETE FROM thread_cursors tc
+                USING posts p, watermark
+                WHERE tc.post_id = p.id AND p.group_id = watermark.group_id
+                AND tc.user_id = %(user_id)s AND tc.seen <= watermark.seen
+            """, {"user_id": user.id, "group_ids": list(group_ids), "seen": timestamp})
+
+class GroupWatermark(models.Model):
+    '''Everything in the group up to seen is read by the user, regardless of thread cursors'''
+    class Meta:
+        db_table = "group_watermarks"
+        constraints = [
+            models.UniqueConstraint(name="groupwatermarks_unique_user_group", fields=['user', 'group'])
+        ]
+
+    objects = GroupWatermarkManager()
+    user = models.ForeignKey(User, on_delete=models.PROTECT, related_name='+', db_index=False)
+    group = models.ForeignKey(Group, on_delete=models.PROTECT, related_name='+')
+    seen = models.DateTimeField()
+
+# A message that fails this many times is given up on
+OUTBOX_MAX_ATTEMPTS = 8
+
+# Seconds to wait before the first retry. Doubles with every failed attempt
+OUTBOX_RETRY_DELAY = 30
+
+class OutboxManager(models.Manager):
+    def enqueue(self, space, event, thread=None, kind=None):
+        '''Queues a google chat message, to be sent by `python manage.py send_notifications`
+
+        Call this within the transaction that creates the post or comment.
+        The message is only sent if the transaction commits, and the request doesn't wait for google chat.
+
+        When settings.NOTIFICATION_COALESCE_WINDOW is set, messages about activity in a thread are held 
+        for that many seconds. Further activity in the thread for the same space is merged into the held 
+        message, so a busy thread sends one card per window instead of one per comment.
+
+        :param thread: the top level post the activity belongs to, or None if the message must not be merged
+        :param kind: what the activity is - 'comment' or 'response'. Used to summarize merged messages
+        '''
+        window = settings.NOTIFICATION_COALESCE_WINDOW
+        if not window or not thread:
+            return self.create(space=space, event=event, available_at=timezone.now())
+
+        # Held messages are not due yet, so the worker doesn't lock them
+        # If the worker picks up the message before this transaction commits, it skips it until the next batch
+        held = self.select_for_update()\
+            .filter(space=space, thread=thread, attempts=0, given_up=False, available_at__gt=timezone.now())\
+            .order_by('id').first()
+        if not held:
+            return self.create(space=space, event=dict(event, counts={kind: 1}), thread=thread, 
+                available_at=timezone.now() + datetime.timedelta(seconds=window))
+        counts = held.event.get('counts', {})
+        counts[kind] = counts.get(kind, 0) + 1
+        held.event = dict(event, counts=counts, heading=_summarize_counts(counts), link_title="View Discussion")
+        held.save(update_fields=['event'])
+        return held
+
+    def send_pending(self, batch_size=50):
+        '''Sends one batch of messages that are due, and returns the bot.BatchResult
+
+        Rows are locked with SKIP LOCKED, so several workers can run at the same time 
+        without sending a message twice. The batch is sent in parallel, see bot.Dispatcher.
+        Sent messages are deleted. A failed message is retried after an exponentially 
+        growing delay, until it has failed OUTBOX_MAX_ATTEMPTS times.
+        If notifications via chat are disabled, nothing is sent and the messages stay in the outbox.
+        '''
+        dispatcher = get_dispatcher()
+        if not dispatcher.enabled:
+            return BatchResult(0, {}, 0.0)
+        with transaction.atomic():
+            messages = list(self.select_for_update(skip_locked=True)\
+                .filter(given_up=False, available_at__lte=timezone.now())\
+                .order_by('available_at', 'id')[:batch_size])
+            result = dispatcher.send([(message.space, message.event) for message in messages])
+            for i, e in result.failures.items():
+                message = messages[i]
+                message.attempts += 1
+                message.last_error = str(e)[:1000]
+                message.given_up = message.attempts >= OUTBOX_MAX_ATTEMPTS
+                message.available_at = timezone.now() + datetime.timedelta(
+                    seconds=OUTBOX_RETRY_DELAY * 2 ** (message.attempts - 1))
+                message.save(update_fields=['attempts', 'last_error', 'given_up', 'available_at'])
+            sent = [message.id for i, message in enumerate(messages) if i not in result.failures]
+            self.filter(id__in=sent).delete()
+        return result
+
+def _summarize_counts(counts):
+    'Heading of a merged notification, for example "3 new comments and 1 new response"'
+    parts = []
+    for kind in sorted(counts):
+        n = counts[kind]
+        parts.append("%d new %s%s" % (n, kind, "" if n == 1 else "s"))
+    return " and ".join(parts)
+
+class OutboxMessage(models.Model):
+    '''Google chat messages waiting to be sent
+
+    Rows are written in the same transaction as the post or comment that triggered them,
+    so a notification is never lost, and never sent for a change that was rolled back. 
+    `python manage.py send_notifications` sends them in the background.
+    Messages that were given up on stay in the table, with the last error, until deleted by hand.
+    '''
+    class Meta:
+        db_table = "notification_outbox"
+        indexes = [
+            models.Index(name="outbox_pending", fields=['available_at', 'id'], condition=Q(given_up=False)),
+            # Finds the held message to merge into, see OutboxManager.enqueue
+            models.Index(name="outbox_held", fields=['space', 'thread'], condition=Q(attempts=0, given_up=False)),
+        ]
+
+    objects = OutboxManager()
+    space = models.CharField(max_length=100)
+    # The event passed to bot.Dispatcher
+    event = JSONField()
+    # Set for messages that can be merged with later activity in the same thread
+    thread = models.ForeignKey(Post, on_delete=models.PROTECT, null=True, blank=True, related_name='+', db_index=False)
+    created = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField()
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    given_up = models.BooleanField(default=False)
+
+# Inserts or refreshes inbox entries for every active user who can see a top level post
+# The caller appends additional conditions to restrict the users, groups or posts
+FILL_INBOX = """
+    INSERT INTO inbox(user_id, post_id, group_id, last_activity, submission_time)
+    SELECT u.id, p.id, p.group_id, p.last_activity, p.submission_time
+    FROM posts p JOIN groups g on p.group_id = g.id
+        JOIN users u on u.is_active = true
+    WHERE p.parent_post_id is null
+    AND (g.group_type = %s OR EXISTS (SELECT 'x'
+        FROM group_members gm WHERE gm.group_id = g.id
+        AND gm.user_id = u.id
+    ))
+"""
+
+FILL_INBOX_ON_CONFLICT = """
+    ON CONFLICT (user_id, post_id) DO UPDATE
+    SET group_id = EXCLUDED.group_id, 
+        last_activity = EXCLUDED.last_activity, 
+        submission_time = EXCLUDED.submission_time
+"""
+
+# Removes inbox entries for posts the user can no longer see
+PRUNE_INBOX = """
+    DELETE FROM inbox as i
+    USING groups g
+    WHERE i.group_id = g.id
+    AND g.group_type <> %s
+    AND NOT EXISTS (SELECT 'x' 
+        FROM group_members gm WHERE gm.group_id = g.id
+        AND gm.user_id = i.user_id
+    )
+"""
+
+class InboxManager(models.Manager):
+    def deliver(self, post):
+        'Adds a newly created top level post to the inbox of every user who can see it'
+        self.rebuild(post_id=post.id)
+
+    def touch(self, post_id, timestamp):
+        'Records new activity on a top level post'
+        self.filter(post_id=post_id).update(last_activity=timestamp)
+
+    def unread_counts(self, user):
+        '''Returns a dictionary of group id to the number of unread posts in the user's inbox
+
+        Computed in a single grouped query, so it is cheap enough to run on every homepage hit.
+        Groups without unread posts are not present in the dictionary.
+        '''
+        pending = ThreadCursor.objects.pending(user)
+        if pending:
+            pending_join = """LEFT JOIN unnest(%s::int[], %s::timestamptz[]) pending(post_id, seen) 
+                on pending.post_id = i.post_id"""
+            seen = "GREATEST(tc.seen, gw.seen, pending.seen)"
+            params = [list(pending.keys()), list(pending.values())]
+        else:
+            pending_join, seen, params = "", "GREATEST(tc.seen, gw.seen)", []
+        with connection.cursor() as c:
+            c.execute("""
+                SELECT i.group_id, count(*)
+                FROM inbox i LEFT JOIN thread_cursors tc 
+                    on tc.post_id = i.post_id and tc.user_id = i.user_id
+                LEFT JOIN group_watermarks gw
+                    on gw.group_id = i.group_id and gw.user_id = i.user_id
+                """ + pending_join + """
+                WHERE i.user_id = %s
+                AND (""" + seen + """ is null OR i.last_activity > """ + seen + """)
+                GROUP BY i.group_id
+            """, params + [user.id])
+            return dict(c.fetchall())
+
+    def rebuild(self, user_id=None, group_id=None, post_id=None):
+        '''Adds missing entries, refreshes existing entries and removes entries the user can no longer see
+
+        Use this after group membership or group type changes. 
+        Without arguments, rebuilds the inbox of every user.
+        '''
+        fill_query = FILL_INBOX
+        prune_query = PRUNE_INBOX
+        fill_params = [Group.OPEN]
+        prune_params = [Group.OPEN]
+        if user_id:
+            fill_query += " AND u.id = %s"
+            prune_query += " AND i.user_id = %s"
+            fill_params.append(user_id)
+            prune_params.append(user_id)
+        if group_id:
+            fill_query += " AND g.id = %s"
+            prune_query += " AND g.id = %s"
+            fill_params.append(group_id)
+            prune_params.append(group_id)
+        if post_id:
+            fill_query += " AND p.id = %s"
+            prune_query += " AND i.post_id = %s"
+            fill_params.append(post_id)
+            prune_params.append(post_id)
+
+        with connection.cursor() as c:
+            c.execute(fill_query + FILL_INBOX_ON_CONFLICT, fill_params)
+            c.execute(prune_query, prune_params)
 
-class LastSeenOnPost(models.Model):
+class InboxEntry(models.Model):
+    '''One row per top level post per user who can see it.
+
+    The home page is a range scan over the inbox of the logged in user,
+    so it doesn't have to check group membership for every post.
+    Entries are added when a post or a user is created, last_activity is updated whenever
+    the post sees new activity, and the inbox is rebuilt when group membership changes.
+    To rebuild all inboxes, run `python manage.py backfill_inbox`.
+    '''
     class Meta:
-        db_table = "last_seen_on_post"
+        db_table = "inbox"
         indexes = [
-            models.Index(name="lastseenonpostindx_user_post", fields=['user', 'post'])
+            models.Index(name="inbox_user_last_activity", fields=['user', '-last_activity', '-post']),
+            models.Index(name="inbox_user_submission_time", fields=['user', '-submission_time', '-post']),
         ]
         constraints = [
-            models.UniqueConstraint(name="lastseenonpost_unique_user_post", fields=['user', 'post'])
+            models.UniqueConstraint(name="inbox_unique_user_post", fields=['user', 'post'])
         ]
-    
-    objects = LastSeenOnPostManager()
+
+    objects = InboxManager()
     user = models.ForeignKey(User, on_delete=models.PROTECT)
-    post = models.ForeignKey(Post, on_delete=models.PROTECT)
-    seen = models.DateTimeField(auto_now=True)
+    post = models.ForeignKey(Post, on_delete=models.PROTECT, related_name='+')
+    group = models.ForeignKey(Group, on_delete=models.PROTECT, related_name='+')
+    # Copies of the corresponding columns in posts, so that the feed can be sorted using an index
+    last_activity = models.DateTimeField()
+    submission_time = models.DateTimeField()
 
 class TagManager(models.Manager):
     def for_user(self, user):
@@ -865,6 +1948,10 @@ class Tag(models.Model):
 class PostTag(models.Model):
     class Meta:
         db_table = "post_tags"
+        indexes = [
+            # Lets the tag feed find posts for a tag without visiting the table
+            models.Index(name="post_tags_tag_post", fields=['tag', 'post']),
+        ]
     
     post = models.ForeignKey(Post, on_delete=models.PROTECT)
     tag = models.ForeignKey(Tag, on_delete=models.PROTECT)
@@ -874,6 +1961,22 @@ class PostSubscribtionManager(models.Manager):
     def subscribe(self, post, user, notify_on):
         PostSubscribtion.objects.update_or_create(post=post, user=user, defaults={'notify_on': notify_on})
 
+    def spaces_to_notify(self, post, everyone, replies, replied_to, exclude):
+        '''Returns the google chat spaces of the subscribers of a post to notify of new activity, in one query
+
+        :param everyone: notify_on preferences that are notified of all activity
+        :param replies: notify_on preferences that are only notified if the subscriber is replied_to
+        :param replied_to: the author of the post that is being replied to
+        :param exclude: ids of users who must not be notified
+        '''
+        return list(self.filter(post=post)\
+            .filter(Q(notify_on__in=everyone) | Q(notify_on__in=replies, user=replied_to))\
+            .exclude(user_id__in=exclude)\
+            .exclude(user__gchat_space__isnull=True)\
+            .exclude(user__gchat_space='')\
+            .values_list('user__gchat_space', flat=True)\
+            .distinct())
+
 class PostSubscribtion(models.Model):
     MUTE = 0
     REPLIES_ONLY = 1
@@ -893,8 +1996,13 @@ class PostSubscribtion(models.Model):
     
     class Meta:
         db_table = "post_subscriptions"
+        indexes = [
+            # Lets spaces_to_notify find and filter the subscribers of a post without visiting the table
+            models.Index(name="post_subscriptions_post_notify", fields=['post', 'notify_on', 'user']),
+        ]
 
     objects = PostSubscribtionManager()
-    post = models.ForeignKey(Post, on_delete=models.PROTECT)
+    # Covered by post_subscriptions_post_notify
+    post = models.ForeignKey(Post, on_delete=models.PROTECT, db_index=False)
     user = models.ForeignKey(User, on_delete=models.PROTECT)
     notify_on = models.IntegerField(choices=_NOTIFY_ON_CHOICES)
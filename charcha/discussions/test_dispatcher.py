@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from httplib2 import Http
+from apiclient.discovery import build
+from django.test import SimpleTestCase, TestCase
+from . import bot
+from .models import OutboxMessage
+
+EVENT = {
+    "heading": "New Comment",
+    "sub_heading": "by ramesh",
+    "image": "https://example.com/ramesh.png",
+    "line1": "Ramesh's Biography",
+    "line2": "<p>Does not matter</p>",
+    "link": "https://example.com/discuss/1/",
+    "link_title": "View Comment",
+}
+
+class FakeChatServer:
+    '''A local stand in for the google chat api
+
+    Serves a discovery document with just spaces.messages.create, and records the messages it receives.
+    Each request takes `delay` seconds, so that tests can observe how many are in flight at a time.
+    Messages to the spaces in `failing_spaces` get a 500.
+    '''
+    def __init__(self, delay=0.05, failing_spaces=()):
+        self.delay = delay
+        self.failing_spaces = set(failing_spaces)
+        self.received = []
+        self.connections = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def chat_client(self):
+        return build('chat', 'v1', http=Http(),
+            discoveryServiceUrl=self.url + '{api}/{apiVersion}', cache_discovery=False)
+
+    def reset(self):
+        with self.lock:
+            self.received = []
+            self.connections = set()
+            self.max_in_flight = 0
+
+    def _handler(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open between requests, like google does
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._reply(200, fake.discovery_document())
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with fake.lock:
+                    fake.connections.add(self.client_address)
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                time.sleep(fake.delay)
+                with fake.lock:
+                    fake.in_flight -= 1
+                space = self.path.split('/v1/')[1].rsplit('/messages', 1)[0]
+                if space in fake.failing_spaces:
+                    return self._reply(500, {"error": {"code": 500, "message": "Internal error"}})
+                with fake.lock:
+                    fake.received.append((space, body))
+                self._reply(200, {"name": space + "/messages/1"})
+
+            def _reply(self, status, body):
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+        return Handler
+
+    def discovery_document(self):
+        create = {
+            "id": "chat.spaces.messages.create",
+            "path": "v1/{+parent}/messages",
+            "httpMethod": "POST",
+            "parameters": {"parent": {"location": "path", "required": True, "type": "string", "pattern": "^spaces/[^/]+$"}},
+            "parameterOrder": ["parent"],
+            "request": {"$ref": "Message"},
+            "response": {"$ref": "Message"},
+        }
+        return {
+            "kind": "discovery#restDescription", "discoveryVersion": "v1",
+            "name": "chat", "version": "v1", "protocol": "rest",
+            "rootUrl": self.url, "servicePath": "", "baseUrl": self.url, "parameters": {},
+            "schemas": {"Message": {"id": "Message", "type": "object", "properties": {}}},
+            "resources": {"spaces": {"resources": {"messages": {"methods": {"create": create}}}}},
+        }
+
+class FakeChatTestMixin:
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.chat = FakeChatServer(failing_spaces=['spaces/broken'])
+        cls.chat_client = cls.chat.chat_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.chat.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.chat.reset()
+
+class DispatcherTests(FakeChatTestMixin, SimpleTestCase):
+    def test_sends_every_message(self):
+        dispatcher = bot.Dispatcher(self.chat_client, Http, concurrency=4)
+        messages = [('spaces/user%d' % i, EVENT) for i in range(10)]
+        result = dispatcher.send(messages)
+
+        self.assertEqual(result.sent, 10)
+        self.assertEqual(result.failures, {})
+        self.assertEqual(sorted(space for space, body in self.chat.received), sorted(space for space, event in messages))
+        body = self.chat.received[0][1]
+        self.assertEqual(body['cards'][0]['header']['title'], "New Comment")
+
+    def test_concurrency_is_bounded(self):
+        dispatcher = bot.Dispatcher(self.chat_client, Http, concurrency=4)
+        dispatcher.send([('spaces/user%d' % i, EVENT) for i in range(16)])
+        self.assertGreater(self.chat.max_in_flight, 1)
+        self.assertLessEqual(self.chat.max_in_flight, 4)
+
+    def test_connections_are_reused_across_batches(self):
+        dispatcher = bot.Dispatcher(self.chat_client, Http, concurrency=4)
+        dispatcher.send([('spaces/user%d' % i, EVENT) for i in range(16)])
+        connections = set(self.chat.connections)
+        self.assertLessEqual(len(connections), 4)
+
+        dispatcher.send([('spaces/user%d' % i, EVENT) for i in range(16)])
+        self.assertEqual(self.chat.connections, connections)
+        self.assertEqual(len(self.chat.received), 32)
+
+    def test_failures_are_reported_per_message(self):
+        dispatcher = bot.Dispatcher(self.chat_client, Http, concurrency=4)
+        messages = [('spaces/user0', EVENT), ('spaces/broken', EVENT), ('spaces/user2', EVENT)]
+        result = dispatcher.send(messages)
+
+        self.assertEqual(result.sent, 2)
+        self.assertEqual(list(result.failures), [1])
+        self.assertEqual(sorted(space for space, body in self.chat.received), ['spaces/user0', 'spaces/user2'])
+
+    def test_disabled_dispatcher_fails_every_message(self):
+        dispatcher = bot.Dispatcher(None, Http)
+        self.assertFalse(dispatcher.enabled)
+        result = dispatcher.send([('spaces/user0', EVENT), ('spaces/user1', EVENT)])
+        self.assertEqual(result.sent, 0)
+        self.assertEqual(list(result.failures), [0, 1])
+
+class OutboxSendTests(FakeChatTestMixin, TestCase):
+    def send_pending_with(self, dispatcher):
+        with mock.patch.object(bot, '_dispatcher', dispatcher):
+            return OutboxMessage.objects.send_pending()
+
+    def test_sent_messages_are_deleted_and_failures_retried(self):
+        for space in ('spaces/user0', 'spaces/broken', 'spaces/user1'):
+            OutboxMessage.objects.enqueue(space, EVENT)
+        result = self.send_pending_with(bot.Dispatcher(self.chat_client, Http, concurrency=2))
+
+        self.assertEqual(result.sent, 2)
+        self.assertEqual(len(self.chat.received), 2)
+        failed = OutboxMessage.objects.get()
+        self.assertEqual(failed.space, 'spaces/broken')
+        self.assertEqual(failed.attempts, 1)
+        self.assertFalse(failed.given_up)
+
+    def test_messages_stay_in_the_outbox_when_notifications_are_disabled(self):
+        OutboxMessage.objects.enqueue('spaces/user0', EVENT)
+        result = self.send_pending_with(bot.Dispatcher(None, Http))
+
+        self.assertEqual((result.sent, result.failures), (0, {}))
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 0)
+        self.assertFalse(message.given_up)
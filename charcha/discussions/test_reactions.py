@@ -0,0 +1,101 @@
+import threading
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from .models import Post, Reaction, User, Group, GroupMember, Role, ScoreChange, GchatSpace
+
+def _create_user(username):
+    return User.objects.create_user(
+        username=username, password="top_secret", email=username + "@hashedin.com")
+
+class ReactionFixtures:
+    def create_fixtures(self):
+        self.ramesh = _create_user("ramesh")
+        self.amit = _create_user("amit")
+        self.swetha = _create_user("swetha")
+        self.outsider = _create_user("outsider")
+        member = Role.objects.create(name="member")
+
+        space = GchatSpace.objects.create(name="universe", space="spaces/universe")
+        self.universe = Group.objects.create(name="universe", group_type=Group.CLOSED, gchat_space=space)
+        for user in (self.ramesh, self.amit, self.swetha):
+            GroupMember.objects.create(group=self.universe, user=user, role=member, added_from_gchat=False)
+        self.post = self.universe.new_post(self.ramesh, Post(title="Ramesh's Biography", html="Does not matter"))
+
+    def summary(self):
+        return Post.objects.get(pk=self.post.pk).reaction_summary
+
+    def score(self, user):
+        return ScoreChange.objects.current_score(user)
+
+class ReactionToggleTests(ReactionFixtures, TestCase):
+    def setUp(self):
+        self.create_fixtures()
+
+    def test_reacting_adds_a_reaction(self):
+        self.assertEqual(self.post.upvote(self.amit), 1)
+        self.assertEqual(self.post.upvote(self.swetha), 2)
+        self.assertEqual(self.summary()['👍'], 2)
+        self.assertEqual(Reaction.objects.filter(post=self.post, reaction='👍').count(), 2)
+        self.assertEqual(self.score(self.ramesh), 2)
+
+    def test_reacting_again_removes_the_reaction(self):
+        self.post.upvote(self.amit)
+        self.assertEqual(self.post.upvote(self.amit), 0)
+        self.assertEqual(self.summary()['👍'], 0)
+        self.assertFalse(Reaction.objects.filter(post=self.post, author=self.amit).exists())
+        self.assertEqual(self.score(self.ramesh), 0)
+
+    def test_switching_reactions(self):
+        self.post.upvote(self.amit)
+        self.post.upvote(self.amit)
+        self.assertEqual(self.post.downvote(self.amit), 1)
+        self.assertEqual(self.summary(), {'👍': 0, '👎': 1})
+        self.assertEqual(list(Reaction.objects.filter(post=self.post, author=self.amit).values_list('reaction', flat=True)), ['👎'])
+        self.assertEqual(self.score(self.ramesh), -1)
+
+    def test_I_cant_react_to_my_own_post(self):
+        self.assertIsNone(self.post.upvote(self.ramesh))
+        self.assertIsNone(Post.objects.react(self.post.id, self.ramesh, '👍'))
+        self.assertFalse(Reaction.objects.filter(post=self.post).exists())
+        self.assertEqual(self.summary(), {})
+        self.assertEqual(self.score(self.ramesh), 0)
+
+    def test_I_cant_react_to_posts_I_cant_see(self):
+        self.assertIsNone(Post.objects.react(self.post.id, self.outsider, '👍'))
+        self.assertFalse(Reaction.objects.filter(post=self.post).exists())
+
+    def test_unknown_reactions_are_ignored(self):
+        self.assertIsNone(self.post.react(self.amit, '🦄'))
+        self.assertFalse(Reaction.objects.filter(post=self.post).exists())
+
+class ConcurrentReactionTests(ReactionFixtures, TransactionTestCase):
+    def setUp(self):
+        self.create_fixtures()
+
+    def test_concurrent_duplicate_reaction_is_counted_once(self):
+        '''Two requests add the same reaction at the same time.
+        The second insert conflicts on the unique constraint, and must not change the count or the score'''
+        first_inserted = threading.Event()
+        results = {}
+
+        def second_request():
+            first_inserted.wait(5)
+            try:
+                # Blocks on the unique index until the first transaction commits
+                results['second'] = Post.objects.react(self.post.id, self.amit, '👍')
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=second_request)
+        thread.start()
+        with transaction.atomic():
+            results['first'] = Post.objects.react(self.post.id, self.amit, '👍')
+            first_inserted.set()
+            # Give the second request time to reach the conflicting insert
+            thread.join(0.5)
+        thread.join(5)
+
+        self.assertEqual(results, {'first': 1, 'second': 1})
+        self.assertEqual(Reaction.objects.filter(post=self.post, author=self.amit).count(), 1)
+        self.assertEqual(self.summary()['👍'], 1)
+        self.assertEqual(self.score(self.ramesh), 1)
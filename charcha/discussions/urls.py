@@ -3,6 +3,7 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.homepage, name="home"),
+    url(r'^mark-all-read/$', views.mark_all_read, name="mark_all_read"),
     
     url(r'^posts/(?P<post_id>\d+)/add-comment$', views.AddEditComment.as_view(), name="add_comment"),
     url(r'^comments/(?P<id>\d+)/edit$', views.AddEditComment.as_view(), name="edit_comment"),
@@ -25,8 +26,10 @@ urlpatterns = [
     url(r'^groups/(?P<group_id>\d+)/sync-members-with-gchat/$', views.sync_members_with_gchat, name="sync-members-with-gchat"),
     url(r'^groups/(?P<group_id>\d+)/new/(?P<post_type>\w+)/$', views.NewPostView.as_view(), name="new-post"),
     url(r'^groups/(?P<group_id>\d+)/$', views.group_home, name="group_home"),
+    url(r'^groups/(?P<group_id>\d+)/mark-all-read/$', views.mark_all_read, name="mark_group_read"),
     
     url(r'^tags/(?P<tag_id>\d+)/$', views.tag_home, name="tag_home"),
+    url(r'^tags/(?P<tag_id>\d+)/mark-all-read/$', views.mark_all_read, name="mark_tag_read"),
 
 
     url(r'^profile/me/$', views.myprofile, name="myprofile"),
@@ -36,6 +39,9 @@ urlpatterns = [
     url(r'^api/posts/(?P<post_id>\d+)/upvote$', views.upvote_post, name="upvote_post"),
     url(r'^api/posts/(?P<post_id>\d+)/downvote$', views.downvote_post, name="downvote_post"),
     url(r'^api/posts/(?P<post_id>\d+)/lastseenat/$', views.update_post_last_seen_at, name="update-last-seen-at"),
+    url(r'^api/posts/lastseenat/$', views.update_posts_last_seen_at, name="update-posts-last-seen-at"),
+    url(r'^api/posts/(?P<post_id>\d+)/changes$', views.thread_changes, name="thread-changes"),
+    url(r'^api/feed/changes$', views.feed_changes, name="feed-changes"),
 
     url(r'^api/members/(?P<member_id>\d+)/assign-role/(?P<role_id>\d+)/$', views.edit_member_role, name="edit-member-role"),
 
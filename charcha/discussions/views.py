@@ -1,5 +1,6 @@
 import json
 import re
+import hashlib
 import os
 import pytz
 import datetime
@@ -24,11 +25,16 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.core.files.storage import DefaultStorage
 from django.core.exceptions import PermissionDenied
-from django.views.decorators.cache import cache_control, never_cache
-
-from .models import Post, Comment, Reaction, User, Group, LastSeenOnPost, PostSubscribtion, Tag
+from django.views.decorators.cache import cache_control
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.conf import settings
+
+from .models import Post, Comment, Reaction, User, Group, ThreadCursor, PostSubscribtion, Tag
 from .models import GroupMember, Role
-from .models import GchatSpace
+from .models import GchatSpace, InboxEntry, PendingReactionDelta, ScoreChange, GroupWatermark
 from .models import comment_cleaner
 from .bot import members as get_members_from_gchat
 
@@ -44,39 +50,121 @@ def prepare_html_for_edit(html):
     'Converts all heading tags to h1 because trix only understands h1 tags'
     return re.sub(regex, r"<h1>\1</h1>", html)    
 
+def check_conditional_get(request, last_modified, *validators):
+    '''Computes validators for a page, and answers a conditional GET if the page hasn't changed
+
+    The ETag combines the validators with everything base.html shows about the user.
+    Returns (etag, response). response is a 304 Not Modified if the browser's copy is current, 
+    otherwise None and the caller renders the page and passes it to set_validators.
+    '''
+    user = request.user
+    components = (user.id, user.username, ScoreChange.objects.current_score(user), user.tzname, bool(user.gchat_space), user.is_staff,
+        request.get_full_path(), request.COOKIES.get(settings.CSRF_COOKIE_NAME)) + validators
+    etag = '"%s"' % hashlib.md5(repr(components).encode("utf-8")).hexdigest()
+    last_modified = int(last_modified.timestamp()) if last_modified else None
+    return etag, get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+def _latest(*timestamps):
+    timestamps = [t for t in timestamps if t]
+    return max(timestamps) if timestamps else None
+
+# Browsers may keep a copy, but must revalidate it using ETag / Last-Modified before showing it
+revalidate = cache_control(private=True, no_cache=True)
+
 @login_required
-@never_cache
+@revalidate
 def homepage(request):
     mode = "home"
     sort_by = request.GET.get('sort_by', 'newactivity')
     if sort_by not in ('newactivity', 'recentposts'):
         sort_by = 'newactivity'
-    posts = Post.objects.get_post_list(request.user, sort_by=sort_by)
-    groups = Group.objects.for_user(request.user).all()
-    return render(request, "home.html", context={"posts": posts, "groups": groups, "selected_sort_by": sort_by, "mode":mode})
+    unread_only = request.GET.get('unread') == '1'
+    version = Post.objects.get_feed_version(request.user)
+    last_modified = _latest(version[0], version[3])
+    etag, not_modified = check_conditional_get(request, last_modified, version, Group.objects.visible_group_ids(request.user))
+    if not_modified:
+        return not_modified
+
+    posts, next_cursor = Post.objects.get_post_list(request.user, sort_by=sort_by, before=request.GET.get('before'), unread_only=unread_only)
+    groups = list(Group.objects.for_user(request.user).all())
+    unread_counts = InboxEntry.objects.unread_counts(request.user)
+    for group in groups:
+        group.unread_count = unread_counts.get(group.id, 0)
+    response = render(request, "home.html", context={"posts": posts, "next_cursor": next_cursor, "groups": groups, "selected_sort_by": sort_by, "unread_only": unread_only, "mode":mode,
+        "SERVER_TIME_ISO": timezone.now().isoformat()})
+    return set_validators(response, etag, last_modified)
 
 @login_required
-@never_cache
+@revalidate
 def group_home(request, group_id):
     mode = "group"
     group = get_object_or_404_check_acl(Group, requester=request.user, pk=group_id)
-    recent_tags = group.recent_tags()
     sort_by = request.GET.get('sort_by', 'newactivity')
     if sort_by not in ('newactivity', 'recentposts'):
         sort_by = 'newactivity'
-    posts = Post.objects.get_post_list(request.user, group=group, sort_by=sort_by)
-    return render(request, "home.html", context={"posts": posts, "group": group, "recent_tags": recent_tags, "selected_sort_by": sort_by, "mode":mode})
+    unread_only = request.GET.get('unread') == '1'
+    version = Post.objects.get_feed_version(request.user, group=group)
+    last_modified = _latest(version[0], version[3])
+    etag, not_modified = check_conditional_get(request, last_modified, version, 
+        group.name, group.purpose, group.description)
+    if not_modified:
+        return not_modified
+
+    recent_tags = group.recent_tags()
+    posts, next_cursor = Post.objects.get_post_list(request.user, group=group, sort_by=sort_by, before=request.GET.get('before'), unread_only=unread_only)
+    response = render(request, "home.html", context={"posts": posts, "next_cursor": next_cursor, "group": group, "recent_tags": recent_tags, "selected_sort_by": sort_by, "unread_only": unread_only, "mode":mode,
+        "SERVER_TIME_ISO": timezone.now().isoformat()})
+    return set_validators(response, etag, last_modified)
 
 @login_required
-@never_cache
+@revalidate
 def tag_home(request, tag_id):
     mode = "tag"
     tag = get_object_or_404_check_acl(Tag, requester=request.user, pk=tag_id)
     sort_by = request.GET.get('sort_by', 'newactivity')
     if sort_by not in ('newactivity', 'recentposts'):
         sort_by = 'newactivity'
-    posts = Post.objects.get_post_list(request.user, tag=tag, sort_by=sort_by)
-    return render(request, "home.html", context={"posts": posts, "tag": tag, "selected_sort_by": sort_by, "mode":mode})
+    unread_only = request.GET.get('unread') == '1'
+    version = Post.objects.get_feed_version(request.user, tag=tag)
+    last_modified = _latest(version[0], version[3])
+    etag, not_modified = check_conditional_get(request, last_modified, version, 
+        tag.fqn, tag.ext_link, tag.attributes)
+    if not_modified:
+        return not_modified
+
+    posts, next_cursor = Post.objects.get_post_list(request.user, tag=tag, sort_by=sort_by, before=request.GET.get('before'), unread_only=unread_only)
+    response = render(request, "home.html", context={"posts": posts, "next_cursor": next_cursor, "tag": tag, "selected_sort_by": sort_by, "unread_only": unread_only, "mode":mode,
+        "SERVER_TIME_ISO": timezone.now().isoformat()})
+    return set_validators(response, etag, last_modified)
+
+@login_required
+@require_http_methods(['POST'])
+def mark_all_read(request, group_id=None, tag_id=None):
+    '''Marks every thread in the home, group or tag feed as read
+
+    last_seen is when the feed was rendered, so that activity the user hasn't seen yet stays unread
+    '''
+    last_seen = _parse_last_seen(request)
+    if not last_seen:
+        return HttpResponseBadRequest("last_seen must be an ISO 8601 timestamp")
+
+    if group_id:
+        group = get_object_or_404_check_acl(Group, requester=request.user, pk=group_id)
+        GroupWatermark.objects.advance(request.user, [group.id], last_seen)
+        return HttpResponseRedirect(reverse('group_home', args=[group.id]))
+    elif tag_id:
+        tag = get_object_or_404_check_acl(Tag, requester=request.user, pk=tag_id)
+        ThreadCursor.objects.mark_tag_read(request.user, tag, last_seen)
+        return HttpResponseRedirect(reverse('tag_home', args=[tag.id]))
+    else:
+        GroupWatermark.objects.advance(request.user, Group.objects.visible_group_ids(request.user), last_seen)
+        return HttpResponseRedirect(reverse('home'))
 
 @login_required
 def set_user_timezone(request):
@@ -110,23 +198,73 @@ class CommentForm(forms.ModelForm):
             'html': 'Your Comment',
         }
 
+# The version in the key changes whenever the thread changes, 
+# the timeout only bounds changes made outside the app, such as tags edited in the admin
+THREAD_CACHE_TIMEOUT = 24 * 60 * 60
+
+def render_thread(post, child_posts, user):
+    '''Returns the rendered html of a thread, from the cache if it hasn't changed since it was rendered
+
+    The html is the same for all users, so it is keyed on the post id and the latest
+    last_modified / last_activity in the thread. See partials/thread.html
+    '''
+    thread_posts = [post] + child_posts
+    version = max(max(p.last_modified, p.last_activity) for p in thread_posts)
+    key = "thread:%d:%d:%d:%s" % (post.id, int(version.timestamp() * 1000000), 
+        len(thread_posts), timezone.get_current_timezone_name())
+    thread = cache.get(key)
+    if thread is None:
+        full_post, full_child_posts = Post.objects.get_post_details(post.id, user)
+        context = {"post": full_post, "child_posts": full_child_posts}
+        thread = {
+            "body": render_to_string("partials/thread.html", context=context),
+            "tags": render_to_string("partials/thread-tags.html", context=context),
+        }
+        cache.set(key, thread, THREAD_CACHE_TIMEOUT)
+    return thread
+
+@method_decorator(revalidate, name='dispatch')
 class PostView(LoginRequiredMixin, View):
     def get(self, request, post_id, slug=None):
-        post, child_posts = Post.objects.get_post_details(post_id, 
-                    request.user)
+        try:
+            post, child_posts, unread_comment_ids = Post.objects.get_thread_state(post_id, 
+                        request.user)
+        except Post.DoesNotExist:
+            raise Http404('No Post matches the given query.')
         if not slug or post.slug != slug:
             post_url = reverse('post', args=[post.id, post.slug])
             return HttpResponsePermanentRedirect(post_url)
 
+        thread_posts = [post] + child_posts
+        overlay = {
+            "user_id": request.user.id,
+            "is_staff": request.user.is_staff,
+            "unread_posts": [p.id for p in thread_posts if not p.is_read],
+            "posts_with_unread_children": [p.id for p in thread_posts if p.has_unread_children],
+            "unread_comments": unread_comment_ids,
+            "upvotes": {p.id: p.upvotes for p in thread_posts},
+            "my_reactions": {p.id: p.my_reactions for p in thread_posts if p.my_reactions},
+        }
+
+        # The overlay covers read state and reactions, the timestamps cover the thread itself
+        last_modified = _latest(*[max(p.last_modified, p.last_activity) for p in thread_posts], 
+            *[p.lastseen_timestamp for p in thread_posts])
+        etag, not_modified = check_conditional_get(request, last_modified, len(thread_posts), overlay, 
+            post.my_subscription, post.title, post.group.name)
+        if not_modified:
+            return not_modified
+
         form = CommentForm()
         context = {
             "post": post, 
-            "child_posts": child_posts, 
+            "thread": render_thread(post, child_posts, request.user),
+            "overlay": overlay,
             "form": form, 
             "SERVER_TIME_ISO": timezone.now().isoformat(),
             "notification_choices": PostSubscribtion.notify_on_choices(),
         }
-        return render(request, "post.html", context=context)
+        response = render(request, "post.html", context=context)
+        return set_validators(response, etag, last_modified)
 
 class AddEditComment(LoginRequiredMixin, View):
     def get(self, request, id=None, post_id=None):
@@ -311,25 +449,178 @@ class EditPostView(LoginRequiredMixin, View):
 @login_required
 @require_http_methods(['POST'])
 def upvote_post(request, post_id):
-    post = get_object_or_404_check_acl(Post, pk=post_id, requester=request.user)
-    upvotes = post.upvote(request.user)
-    return HttpResponse(upvotes)
+    return _react(request, post_id, '👍')
 
 @login_required
 @require_http_methods(['POST'])
 def downvote_post(request, post_id):
-    post = get_object_or_404_check_acl(Post, pk=post_id, requester=request.user)
-    downvotes = post.downvote(request.user)
-    return HttpResponse(downvotes)
+    return _react(request, post_id, '👎')
+
+def _react(request, post_id, reaction_emoji):
+    count = Post.objects.react(post_id, request.user, reaction_emoji)
+    if count is None:
+        # Either the post doesn't exist, the user cannot see it, or the user is voting on their own post
+        post = get_object_or_404_check_acl(Post, pk=post_id, requester=request.user)
+        PendingReactionDelta.objects.merge_into([post])
+        count = post.reaction_summary.get(reaction_emoji, 0)
+    return HttpResponse(count)
 
 @login_required
 @require_http_methods(['POST'])
 def update_post_last_seen_at(request, post_id):
-    last_seen_str = request.POST['last_seen']
-    last_seen = datetime.datetime.fromisoformat(last_seen_str)
-    LastSeenOnPost.objects.upsert(request.user, post_id, last_seen)
+    last_seen = _parse_last_seen(request)
+    if not last_seen:
+        return HttpResponseBadRequest("last_seen must be an ISO 8601 timestamp")
+    try:
+        ThreadCursor.objects.upsert(request.user, post_id, last_seen)
+    except Post.DoesNotExist:
+        raise Http404('No Post matches the given query.')
     return HttpResponse('OK')
 
+# Upper limit on the number of posts in one call to update_posts_last_seen_at
+MAX_POSTS_PER_LAST_SEEN = 500
+
+@login_required
+@require_http_methods(['POST'])
+def update_posts_last_seen_at(request):
+    '''Marks the threads of several posts as seen in one call. Expects a post_id parameter per post, and last_seen
+
+    Returns the ids of the threads that were marked as seen, which excludes posts the user cannot see
+    '''
+    bad_request = HttpResponseBadRequest("Expected last_seen as an ISO 8601 timestamp, and numeric post_id parameters")
+    last_seen = _parse_last_seen(request)
+    if not last_seen:
+        return bad_request
+    try:
+        post_ids = [int(post_id) for post_id in request.POST.getlist('post_id')]
+    except ValueError:
+        return bad_request
+    if len(post_ids) > MAX_POSTS_PER_LAST_SEEN:
+        return HttpResponseBadRequest("Cannot mark more than %d posts as seen at once" % MAX_POSTS_PER_LAST_SEEN)
+    seen = ThreadCursor.objects.upsert_many(request.user, post_ids, last_seen)
+    return JsonResponse({"seen": seen})
+
+def _parse_timestamp(value):
+    'Parses an ISO 8601 timestamp, assuming UTC if it has no offset. Returns None if missing or invalid'
+    try:
+        timestamp = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, timezone.utc)
+    return timestamp
+
+def _parse_since(request):
+    'Parses the since parameter of the changes api. Returns None if missing or invalid'
+    return _parse_timestamp(request.GET.get('since'))
+
+def _parse_last_seen(request):
+    '''Parses the last_seen parameter of the read tracking apis. Returns None if missing or invalid
+
+    The timestamp comes from the client, so it is capped at the current time.
+    Otherwise a skewed clock would mark replies that haven't been written yet as read.
+    '''
+    last_seen = _parse_timestamp(request.POST.get('last_seen'))
+    if not last_seen:
+        return None
+    return min(last_seen, timezone.now())
+
+def _author_to_json(author):
+    return {
+        "id": author.id,
+        "username": author.username,
+        "name": (author.first_name + " " + author.last_name).strip(),
+        "avatar": author.avatar,
+    }
+
+@login_required
+@require_http_methods(['GET'])
+def thread_changes(request, post_id):
+    '''Returns posts and comments in a thread that changed since a timestamp
+
+    Pass the "now" from the previous response as "since" in the next request.
+    The post page uses this to poll for new activity, see main.js
+    '''
+    now = timezone.now()
+    since = _parse_since(request)
+    if not since:
+        return HttpResponseBadRequest("since must be an ISO 8601 timestamp")
+    try:
+        posts, comments = Post.objects.get_thread_changes(post_id, request.user, since)
+    except Post.DoesNotExist:
+        raise Http404('No Post matches the given query.')
+
+    return JsonResponse({
+        "now": now.isoformat(),
+        "posts": [_changed_post_to_json(post) for post in posts],
+        "comments": [_changed_comment_to_json(comment) for comment in comments],
+    })
+
+def _changed_post_to_json(post):
+    # Clients only need to know that a deleted post is gone, not what it said or who wrote it
+    if post.is_deleted:
+        return {"id": post.id, "parent_post_id": post.parent_post_id, "is_deleted": True}
+    return {
+        "id": post.id,
+        "parent_post_id": post.parent_post_id,
+        "title": post.title,
+        "html": post.html,
+        "author": _author_to_json(post.author),
+        "submission_time": post.submission_time,
+        "last_modified": post.last_modified,
+        "is_deleted": False,
+    }
+
+def _changed_comment_to_json(comment):
+    if comment.is_deleted:
+        return {"id": comment.id, "post_id": comment.post_id, "is_deleted": True}
+    return {
+        "id": comment.id,
+        "post_id": comment.post_id,
+        "html": comment.html,
+        "author": _author_to_json(comment.author),
+        "submission_time": comment.submission_time,
+        "last_modified": comment.last_modified,
+        "is_deleted": False,
+    }
+
+@login_required
+@require_http_methods(['GET'])
+def feed_changes(request):
+    '''Returns top level posts with new activity since a timestamp, for the home page or a group or tag
+
+    Pass the "now" from the previous response as "since" in the next request.
+    '''
+    now = timezone.now()
+    since = _parse_since(request)
+    if not since:
+        return HttpResponseBadRequest("since must be an ISO 8601 timestamp")
+    try:
+        group_id = int(request.GET['group']) if request.GET.get('group') else None
+        tag_id = int(request.GET['tag']) if request.GET.get('tag') else None
+    except ValueError:
+        return HttpResponseBadRequest("group and tag must be numeric ids")
+    group = tag = None
+    if group_id:
+        group = get_object_or_404_check_acl(Group, requester=request.user, pk=group_id)
+    if tag_id:
+        tag = get_object_or_404_check_acl(Tag, requester=request.user, pk=tag_id)
+    
+    posts = Post.objects.get_feed_changes(request.user, since, group=group, tag=tag)
+    return JsonResponse({
+        "now": now.isoformat(),
+        "posts": [{
+            "id": post.id,
+            "title": post.title,
+            "excerpt": post.excerpt,
+            "url": reverse('post', args=[post.id, post.slug]),
+            "author": _author_to_json(post.author),
+            "group": {"id": post.group.id, "name": post.group.name},
+            "submission_time": post.submission_time,
+            "last_activity": post.last_activity,
+        } for post in posts],
+    })
+
 @login_required
 @require_http_methods(['POST'])
 def subscribe_to_post(request, post_id):
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
+import threading
 
 import dj_database_url
 import dj_email_url
@@ -26,6 +28,9 @@ def is_ec2_linux():
             return uuid.startswith("ec2")
     return False
 
+# Seconds to wait for the EC2 metadata service
+EC2_METADATA_TIMEOUT = 2
+
 def get_linux_ec2_private_ip():
     """Get the private IP Address of the machine if running on an EC2 linux server"""
     try:
@@ -35,13 +40,47 @@ def get_linux_ec2_private_ip():
     if not is_ec2_linux():
         return None
     try:
-        response = urlopen('http://169.254.169.254/latest/meta-data/local-ipv4')
-        return response.read()
+        with urlopen('http://169.254.169.254/latest/meta-data/local-ipv4', timeout=EC2_METADATA_TIMEOUT) as response:
+            return response.read().decode('ascii').strip()
     except:
         return None
-    finally:
-        if response:
-            response.close()
+
+class LazyAllowedHosts(list):
+    """ALLOWED_HOSTS that adds the private IP of the EC2 instance the first time django reads it
+
+    Looking up the IP is a network call, which would otherwise run whenever settings are imported -
+    in every worker, management command and test run.
+    """
+    def __init__(self, hosts):
+        super().__init__(hosts)
+        self._lock = threading.Lock()
+        self._probed = False
+
+    def _probe(self):
+        if self._probed:
+            return
+        with self._lock:
+            if not self._probed:
+                private_ip = get_linux_ec2_private_ip()
+                if private_ip:
+                    self.append(private_ip)
+                self._probed = True
+
+    def __iter__(self):
+        self._probe()
+        return super().__iter__()
+
+    def __len__(self):
+        self._probe()
+        return super().__len__()
+
+    def __contains__(self, host):
+        self._probe()
+        return super().__contains__(host)
+
+    def __getitem__(self, index):
+        self._probe()
+        return super().__getitem__(index)
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -62,10 +101,7 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 # ElasticBeanstalk healthcheck sends requests with host header = internal ip
 # So we detect if we are in elastic beanstalk, 
 # and add the instances private ip address
-ALLOWED_HOSTS = ['localhost', '127.0.0.1', 'charcha']
-private_ip = get_linux_ec2_private_ip()
-if private_ip:
-    ALLOWED_HOSTS.append(private_ip)
+ALLOWED_HOSTS = LazyAllowedHosts(['localhost', '127.0.0.1', 'charcha'])
 
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -112,6 +148,7 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'social_django.context_processors.backends',
                 'social_django.context_processors.login_redirect',
+                'charcha.discussions.context_processors.user_score',
             ],
         },
     },
@@ -140,6 +177,57 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# The cache is shared by all gunicorn workers, 
+# so that invalidating an entry in one worker is visible to the others.
+# In production, point MEMCACHED_LOCATION to memcached (host:port), so that a cache hit is not a database query.
+# Otherwise the cache lives in a database table - create it with `python manage.py createcachetable`, 
+# the migrations also create it. It holds an entry per user and per rendered thread,
+# so it needs far more than the default of 300 entries, and culls a tenth when full instead of a third.
+_memcached_location = os.environ.get('MEMCACHED_LOCATION')
+if _memcached_location:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': _memcached_location,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'charcha_cache',
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '100000')),
+                'CULL_FREQUENCY': 10,
+            }
+        }
+    }
+
+# When true, reactions don't update posts.reaction_summary directly
+# Instead, the deltas are buffered and applied by `python manage.py flush_reaction_counters`
+# Turn this on if bursts of reactions on the same post contend on row locks
+_reaction_counters_write_behind = os.environ.get('REACTION_COUNTERS_WRITE_BEHIND', 'False')
+REACTION_COUNTERS_WRITE_BEHIND = (_reaction_counters_write_behind == "True" or _reaction_counters_write_behind == "true")
+
+# When true, last seen timestamps are buffered in the cache and written to thread_cursors 
+# by `python manage.py flush_last_seen --interval LAST_SEEN_FLUSH_INTERVAL`. 
+# Turn this on if read tracking dominates database writes. It only helps with MEMCACHED_LOCATION set, 
+# the database cache would turn every buffered write into a database write again
+_last_seen_write_behind = os.environ.get('LAST_SEEN_WRITE_BEHIND', 'False')
+LAST_SEEN_WRITE_BEHIND = (_last_seen_write_behind == "True" or _last_seen_write_behind == "true")
+LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', '60'))
+
+# When set, notifications about new comments and responses in a thread are held for this many seconds,
+# and further activity in the thread is merged into one notification per user. 0 sends every event
+NOTIFICATION_COALESCE_WINDOW = int(os.environ.get('NOTIFICATION_COALESCE_WINDOW', '0'))
+
+# Number of google chat messages `python manage.py send_notifications` sends in parallel
+GOOGLE_CHAT_CONCURRENCY = int(os.environ.get('GOOGLE_CHAT_CONCURRENCY', '8'))
+
+# Where google api discovery documents are cached, see bot.DiscoveryCache
+GOOGLE_DISCOVERY_CACHE_DIR = os.environ.get('GOOGLE_DISCOVERY_CACHE_DIR', 
+    os.path.join(tempfile.gettempdir(), 'charcha-discovery-cache'))
+
 # Get configuration of email from environment variables
 EMAIL_URL = os.environ.get('EMAIL_URL')
 SENDGRID_USERNAME = os.environ.get('SENDGRID_USERNAME')
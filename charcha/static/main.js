@@ -28,6 +28,7 @@ $('.upvote-button').click(function(){
     $.post(url, {'csrfmiddlewaretoken': csrftoken })
         .done(function(data){
           score.html(data);
+          elem.toggleClass("reacted");
         })
         .fail(function(data){
           score.html('?');
@@ -145,6 +146,41 @@ $('.upvote-button').click(function(){
     });
   });
 
+/*
+ * The rendered thread on the post page is shared by all users, see partials/thread.html
+ * Everything that depends on the logged in user is sent separately as json, and applied here.
+ * This must run before the read tracking logic below, because it looks for unread posts
+ */
+function applyThreadOverlay(overlay) {
+  $.each(overlay.unread_posts, function(index, postId) {
+    $("#post-" + postId).removeClass("read").addClass("unread");
+    $('[data-unread-indicator="post-' + postId + '"]').removeClass("d-none");
+  });
+  $.each(overlay.posts_with_unread_children, function(index, postId) {
+    $("#post-" + postId).addClass("has-unread-children");
+  });
+  $.each(overlay.unread_comments, function(index, commentId) {
+    $("#comment-" + commentId).removeClass("read").addClass("unread")
+      .find(".unread-indicator").removeClass("d-none");
+  });
+  $.each(overlay.upvotes, function(postId, upvotes) {
+    $('.upvote-button[data-object-type="posts"][data-object-id="' + postId + '"] .score').text(upvotes);
+  });
+  $.each(overlay.my_reactions, function(postId, reactions) {
+    $.each(reactions, function(index, reaction) {
+      $('.upvote-button[data-object-type="posts"][data-object-id="' + postId + '"][data-reaction="' + reaction + '"]')
+        .addClass("reacted");
+    });
+  });
+
+  // Users can edit their own posts and comments, but cannot upvote them
+  $('[data-owner-only="' + overlay.user_id + '"]').removeClass("d-none");
+  $('.upvote-button[data-author-id="' + overlay.user_id + '"]').prop("disabled", true);
+  if (overlay.is_staff) {
+    $("[data-staff-only]").removeClass("d-none");
+  }
+}
+
 /*
  * Logic to detect if a user has read a post
  * 
@@ -157,9 +193,14 @@ $('.upvote-button').click(function(){
  * 
  * Now, if a post is read, and all it's child comments have also been read, we don't do any of these checks
  * 
- * To notify the server, we update the lastSeenTime for the post. The lastSeenTime is the time on the server
- * when the page was loaded. So if the page loaded at 10:00 AM, and I read the posts and it's comments at 10:15 AM,
- * the API call to the server will indicate the post was lastSeenAt 10:00 AM. 
+ * The server keeps one lastSeenTime per thread - everything that changed before it is read.
+ * So we order the unread posts by when they last changed (data-last-activity on .end-of-post),
+ * and every time a post is read, we send the last activity of the last post read without a gap.
+ * If I read the 3 oldest of 5 unread posts, the thread is lastSeenAt the 3rd post, and the other 2 stay unread.
+ *
+ * Once every unread post has been read, lastSeenTime is the time on the server when the page was loaded. 
+ * So if the page loaded at 10:00 AM, and I read the posts and it's comments at 10:15 AM,
+ * the API call to the server will indicate the thread was lastSeenAt 10:00 AM. 
  * This way, posts and comments created between 10:00 AM and 10:15 AM will still show as unread
  * 
  * We can revisit this strategy if we actively poll the server for new changes, but that isn't on the roadmap for now at least.
@@ -205,15 +246,49 @@ function onceUserHasReadPost(callback) {
   }
 }
 
+/*
+ * The time up to which the user has read every unread post, or null if they haven't read the oldest one yet
+ * unreadPosts must be ordered by time
+ */
+function lastSeenTime(unreadPosts, readPostIds) {
+  var lastSeen = null;
+  for (var i = 0; i < unreadPosts.length; i++) {
+    var post = unreadPosts[i];
+    if (!readPostIds[post.id]) {
+      return lastSeen;
+    }
+    // Posts that changed in the same millisecond must all be read before we can move past them
+    var next = unreadPosts[i + 1];
+    if (next && next.time > post.time) {
+      lastSeen = post.lastActivity;
+    }
+  }
+  // serverTimeISO is a global variable created on page load in post.html
+  return serverTimeISO;
+}
+
 // Add scroll handler only if we are on the posts page
 $(window).on('DOMContentLoaded', function(){
   if ($("div.post-details").length > 0) {
     var csrftoken = getCookie('csrftoken');
-    var userReadPostHandler = onceUserHasReadPost(function(postId) {
-      var url = "/api/posts/" + postId + "/lastseenat/";
+    var url = "/api/posts/lastseenat/";
+    var threadId = $("div.post-details").data("thread-id");
+    var unreadPosts = $("div.post.unread .end-of-post, div.post.has-unread-children .end-of-post").map(function(index, el) {
+      var lastActivity = $(el).data("last-activity");
+      return {id: $(el).data("post-id"), lastActivity: lastActivity, time: Date.parse(lastActivity)};
+    }).get();
+    unreadPosts.sort(function(a, b) { return a.time - b.time; });
+    var readPostIds = {};
+    var lastSent = null;
 
-      // serverTimeISO is a global variable created on page load in post.html
-      $.post(url, {'csrfmiddlewaretoken': csrftoken, "last_seen": serverTimeISO });
+    var userReadPostHandler = onceUserHasReadPost(function(postId) {
+      readPostIds[postId] = true;
+      var lastSeen = lastSeenTime(unreadPosts, readPostIds);
+      if (lastSeen && lastSeen != lastSent) {
+        lastSent = lastSeen;
+        var data = {'csrfmiddlewaretoken': csrftoken, "last_seen": lastSeen, "post_id": [threadId]};
+        $.ajax({url: url, method: "POST", data: data, traditional: true});
+      }
     });
 
     /* Call our handler immediately the first time round */
@@ -226,6 +301,56 @@ $(window).on('DOMContentLoaded', function(){
 
 /* END logic to detect if a post is read */
 
+/*
+ * Poll for new activity on the post page
+ * 
+ * Every minute, we ask the server for posts and comments that changed since the page was loaded.
+ * If someone else replied or commented, we show a banner. Clicking it reloads the page,
+ * which is cheap because the rendered thread is cached on the server.
+ */
+var THREAD_POLL_INTERVAL_MS = 60 * 1000;
+
+function pollThreadChanges(postId, userId, since) {
+  var url = "/api/posts/" + postId + "/changes";
+  // Posts and comments that are not on the page, keyed by their element id
+  var newActivity = {};
+
+  function isNew(elementId, item) {
+    // Deleted posts and comments come without an author
+    return !item.is_deleted && item.author.id != userId && $("#" + elementId).length == 0;
+  }
+
+  setInterval(function() {
+    // Don't poll from background tabs
+    if (document.hidden) {
+      return;
+    }
+    $.getJSON(url, {"since": since}).done(function(data) {
+      since = data.now;
+      $.each(data.posts, function(index, post) {
+        if (isNew("post-" + post.id, post)) {
+          newActivity["post-" + post.id] = "posts";
+        }
+      });
+      $.each(data.comments, function(index, comment) {
+        if (isNew("comment-" + comment.id, comment)) {
+          newActivity["comment-" + comment.id] = "comments";
+        }
+      });
+      var counts = {"posts": 0, "comments": 0};
+      $.each(newActivity, function(elementId, kind) {
+        counts[kind]++;
+      });
+      if (counts.posts + counts.comments > 0) {
+        var banner = $("#new-activity");
+        banner.find('[data-count="posts"]').text(counts.posts);
+        banner.find('[data-count="comments"]').text(counts.comments);
+        banner.removeClass("d-none");
+      }
+    });
+  }, THREAD_POLL_INTERVAL_MS);
+}
+
 
 /*
 * Adds Mentions to Trix editor using tribute
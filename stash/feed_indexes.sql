@@ -0,0 +1,64 @@
+-- Before/after EXPLAIN ANALYZE for the feed indexes added in migration 0038_feed_indexes
+-- Run against a scratch database that has the charcha schema and at least one user
+--     psql -f stash/feed_indexes.sql scratch > stash/feed_indexes.txt
+-- Results from a run are recorded in stash/feed_indexes.txt
+
+\timing off
+SET client_min_messages = warning;
+
+-- Synthetic dataset: 100 groups, 400k top level posts, 100k replies, 200 tags, 300k post tags
+INSERT INTO groups(name, group_type, is_deleted, purpose, description)
+SELECT 'synthetic-' || g, g % 3, false, '', ''
+FROM generate_series(1, 100) g;
+
+INSERT INTO posts(group_id, title, slug, author_id, submission_time, last_modified, last_activity,
+    parent_post_id, post_type, html, excerpt, is_deleted, sticky, accepted_answer, resolved,
+    num_comments, reaction_summary, score)
+SELECT grp.ids[1 + (n % 100)], 'Post ' || n, 'post-' || n, (SELECT min(id) FROM users),
+    now() - (n || ' minutes')::interval, now(),
+    now() - ((n::bigint * 7919 % 400000) || ' minutes')::interval,
+    null, 0, '<p>synthetic</p>', 'synthetic', false, false, false, false, 0, '{}', 0
+FROM generate_series(1, 400000) n,
+    (SELECT array_agg(id ORDER BY id) ids FROM groups WHERE name like 'synthetic-%') grp;
+
+INSERT INTO posts(group_id, title, slug, author_id, submission_time, last_modified, last_activity,
+    parent_post_id, post_type, html, excerpt, is_deleted, sticky, accepted_answer, resolved,
+    num_comments, reaction_summary, score)
+SELECT p.group_id, null, null, p.author_id, now(), now(), now(), p.id, 16, '<p>reply</p>', 'reply',
+    false, false, false, false, 0, '{}', 0
+FROM posts p WHERE p.parent_post_id is null AND p.id % 4 = 0;
+
+INSERT INTO tags(name, parent_id, fqn, is_external, is_visible, attributes)
+SELECT 'synthetic-' || t, null, 'synthetic-' || t, false, true, '{}'
+FROM generate_series(1, 200) t;
+
+INSERT INTO post_tags(post_id, tag_id, tagged_on)
+SELECT p.id, tg.ids[1 + ((p.id * 31 + k) % 200)], now()
+FROM posts p, generate_series(0, 2) k,
+    (SELECT array_agg(id ORDER BY id) ids FROM tags WHERE name like 'synthetic-%') tg
+WHERE p.parent_post_id is null AND (p.id + k) % 4 = 0;
+
+SELECT min(id) AS sample_group FROM groups WHERE name = 'synthetic-42' \gset
+SELECT min(id) AS sample_tag FROM tags WHERE name = 'synthetic-17' \gset
+SELECT array_agg(id) AS visible_groups FROM groups WHERE name like 'synthetic-%' AND group_type = 0 OR name = 'synthetic-42' \gset
+
+-- Before: drop the new indexes
+DROP INDEX IF EXISTS posts_feed_last_activity, posts_feed_submission_time,
+    posts_group_last_activity, posts_group_submission_time, post_tags_tag_post;
+VACUUM ANALYZE posts;
+VACUUM ANALYZE post_tags;
+
+\echo '==================== BEFORE ===================='
+\ir feed_indexes_queries.sql
+
+-- After: the indexes from migration 0038_feed_indexes
+CREATE INDEX posts_feed_last_activity ON posts (last_activity DESC, id DESC) WHERE parent_post_id IS NULL;
+CREATE INDEX posts_feed_submission_time ON posts (submission_time DESC, id DESC) WHERE parent_post_id IS NULL;
+CREATE INDEX posts_group_last_activity ON posts (group_id, last_activity DESC, id DESC) WHERE parent_post_id IS NULL;
+CREATE INDEX posts_group_submission_time ON posts (group_id, submission_time DESC, id DESC) WHERE parent_post_id IS NULL;
+CREATE INDEX post_tags_tag_post ON post_tags (tag_id, post_id);
+VACUUM ANALYZE posts;
+VACUUM ANALYZE post_tags;
+
+\echo '==================== AFTER ===================='
+\ir feed_indexes_queries.sql
@@ -0,0 +1,40 @@
+-- The feed queries issued by PostsManager.get_post_list, used by feed_indexes.sql
+
+\echo '---- group feed, sort by new activity ----'
+EXPLAIN (ANALYZE, COSTS OFF, TIMING ON)
+SELECT p.id, p.title, p.slug, p.excerpt, p.submission_time, p.last_activity, p.author_id, p.group_id
+FROM posts p
+WHERE p.group_id = ANY(:'visible_groups'::int[]) AND p.parent_post_id IS NULL AND p.group_id = :sample_group
+ORDER BY p.last_activity DESC, p.id DESC
+LIMIT 26;
+
+\echo '---- group feed, sort by recent posts, third page ----'
+EXPLAIN (ANALYZE, COSTS OFF, TIMING ON)
+SELECT p.id, p.title, p.slug, p.excerpt, p.submission_time, p.last_activity, p.author_id, p.group_id
+FROM posts p
+WHERE p.group_id = ANY(:'visible_groups'::int[]) AND p.parent_post_id IS NULL AND p.group_id = :sample_group
+AND p.submission_time <= now() - interval '5000 minutes'
+AND (p.submission_time < now() - interval '5000 minutes' OR p.id < 2147483647)
+ORDER BY p.submission_time DESC, p.id DESC
+LIMIT 26;
+
+\echo '---- all visible groups, sort by new activity ----'
+EXPLAIN (ANALYZE, COSTS OFF, TIMING ON)
+SELECT p.id, p.title, p.slug, p.excerpt, p.submission_time, p.last_activity, p.author_id, p.group_id
+FROM posts p
+WHERE p.group_id = ANY(:'visible_groups'::int[]) AND p.parent_post_id IS NULL
+ORDER BY p.last_activity DESC, p.id DESC
+LIMIT 26;
+
+\echo '---- tag feed, sort by new activity ----'
+EXPLAIN (ANALYZE, COSTS OFF, TIMING ON)
+SELECT p.id, p.title, p.slug, p.excerpt, p.submission_time, p.last_activity, p.author_id, p.group_id
+FROM posts p
+WHERE p.group_id = ANY(:'visible_groups'::int[]) AND p.parent_post_id IS NULL
+AND EXISTS (SELECT 1 FROM post_tags pt WHERE pt.post_id = p.id AND pt.tag_id = :sample_tag)
+ORDER BY p.last_activity DESC, p.id DESC
+LIMIT 26;
+
+\echo '---- tag counts for recent tags ----'
+EXPLAIN (ANALYZE, COSTS OFF, TIMING ON)
+SELECT count(*) FROM post_tags pt WHERE pt.tag_id = :sample_tag;